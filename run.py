@@ -35,6 +35,17 @@ def setup_seed(seed):
     torch.backends.cudnn.deterministic = True
 
 
+def setup_cuda_allocator(expandable_segments: bool = True) -> None:
+    """Let the caching allocator grow its segments instead of allocating new blocks for every differently sized
+    temporary. This avoids fragmentation and repeated cudaMalloc / cudaFree syncs in the per-frame tracking loop.
+
+    NOTE this needs to happen before CUDA is initialized, spawned processes inherit the environment variable.
+    An already set PYTORCH_CUDA_ALLOC_CONF always takes precedence!
+    """
+    if expandable_segments:
+        os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True")
+
+
 def backup_source_code(backup_directory):
     ignore_hidden = shutil.ignore_patterns(
         ".",
@@ -95,6 +106,7 @@ def run_slam(cfg):
     with open(os.path.join(output_folder, "config.yaml"), "w") as f:
         yaml.dump(OmegaConf.to_container(cfg), f, default_flow_style=False)
 
+    setup_cuda_allocator(cfg.get("expandable_segments", True))
     setup_seed(43)
     torch.multiprocessing.set_start_method("spawn")
     # Save state for reproducibility
@@ -52,6 +52,9 @@ class DepthVideo:
         buffer = cfg.tracking.buffer
         # Whether we upsample the predictions or not
         self.upsampled = cfg.tracking.upsample
+        # Assemble the normal equations of the Python BA in bfloat16, which loses precision in H and v
+        # (falls back to float32 on older GPUs)
+        self.ba_compute_dtype = torch.bfloat16 if cfg.tracking.get("ba_bf16", False) else torch.float32
 
         ### state attributes -> Raw map ###
         self.timestamp = torch.zeros(buffer, device=device, dtype=torch.float).share_memory_()
@@ -699,6 +702,7 @@ class DepthVideo:
                     scale_prior=True,
                     structure_only=True,
                     alpha=alpha,
+                    compute_dtype=self.ba_compute_dtype,
                 )
                 self.mapping_dirty[t0:t1] = True
 
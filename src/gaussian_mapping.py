@@ -980,7 +980,7 @@ class GaussianMapper(object):
             )
         else:
             if mapping_queue is not None:
-                mapping_queue.put("None")
+                mapping_queue.put(None)
         if received_item is not None:
             received_item.wait()  # Wait until the Packet got delivered
 
@@ -1,40 +1,31 @@
-import json
+import orjson
+import csv
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from termcolor import colored
 from tqdm import tqdm
-import ipdb
 import pickle
 from typing import List, Dict, Optional, Tuple
 from omegaconf import DictConfig
 import os
+import threading
 
 import numpy as np
-import pandas as pd
 import cv2
-import matplotlib.pyplot as plt
 
 import torch
-from torchmetrics.image.lpip import LearnedPerceptualImagePatchSimilarity
-from lietorch import SE3
-from ..geom import matrix_to_lie
+from torch.utils.data import DataLoader, Subset
 
-from evo.core import metrics, sync
+from ..geom import matrix_to_lie, lie_to_matrix
 
-# NOTE chen: MonoGS uses PosePath3D, everyone else uses PoseTrajectory3D which seems more compatible with our video structure
-from evo.core.trajectory import PoseTrajectory3D
-from evo.tools.plot import PlotMode, prepare_axis, traj, traj_colormap
-from matplotlib import pyplot as plt
-
-from evo.tools.settings import SETTINGS
-from matplotlib import pyplot as plt
-
-from .gaussian_renderer import render
+from .gaussian_renderer import render, render_gsplat, HAS_GSPLAT
 from .scene.gaussian_model import GaussianModel
 from .camera_utils import Camera
-from ..depth_video import DepthVideo
 from ..losses.image import ssim  # TODO chen: refactor these by simply importing them in __init__ of submodule?
+# NOTE ssim caches its gaussian window per (channels, device, dtype), so calling it per batch does not reallocate it
 from ..losses.misc import l1_loss
 from ..losses.depth import ScaleAndShiftInvariantLoss
-from ..utils import psnr, mkdir_p, clone_obj
+from ..utils import mkdir_p, clone_obj, collate_single_item
 
 
 class EvaluatePacket:
@@ -85,44 +76,52 @@ class EvaluatePacket:
         print("Im getting something: {} {}".format(self.pipeline_params, len(self.cameras)))
 
 
-def create_odometry_csv(results_kf: Dict, results_all: Dict, cfg: DictConfig, input_path: str) -> Dict:
-    csv_dict = {
-        "ate_on_keyframes_only": [True, False],
-        "run_backend": [str(cfg.run_backend), str(cfg.run_backend)],
-        "run_mapping": [str(cfg.run_mapping), str(cfg.run_mapping)],
-        "stride": [str(cfg.stride), str(cfg.stride)],
-        "loop_closure": [
-            str(cfg.tracking.backend.use_loop_closure),
-            str(cfg.tracking.backend.use_loop_closure),
-        ],
-        "loop_detector": [str(cfg.run_loop_detection), str(cfg.run_loop_detection)],
-        "dataset": [input_path, input_path],
-        "mode": [cfg.mode, cfg.mode],
-        "ape": [results_kf["mean"], results_all["mean"]],
-        "ate": [results_kf["rmse"], results_all["rmse"]],
+def write_csv(rows: List[Dict], path: str) -> None:
+    """Write a list of result rows with the same keys into a csv file with a header."""
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def create_odometry_csv(results_kf: Dict, results_all: Dict, cfg: DictConfig, input_path: str) -> List[Dict]:
+    shared = {
+        "run_backend": cfg.run_backend,
+        "run_mapping": cfg.run_mapping,
+        "stride": cfg.stride,
+        "loop_closure": cfg.tracking.backend.use_loop_closure,
+        "loop_detector": cfg.run_loop_detection,
+        "dataset": input_path,
+        "mode": cfg.mode,
     }
-    return csv_dict
-
-
-def create_rendering_csv(results_kf, results_nonkf, cfg: DictConfig, input_path: str) -> Dict:
-    csv_dict = {
-        "run_backend": [str(cfg.run_backend), str(cfg.run_backend)],
-        "run_mapping": [str(cfg.run_mapping), str(cfg.run_mapping)],
-        "stride": [str(cfg.stride), str(cfg.stride)],
-        "loop_closure": [str(cfg.tracking.backend.use_loop_closure), str(cfg.tracking.backend.use_loop_closure)],
-        "loop_detector": [str(cfg.run_loop_detection), str(cfg.run_loop_detection)],
-        "dataset": [input_path, input_path],
-        "mode": [cfg.mode, cfg.mode],
-        "psnr": [results_kf["mean_psnr"], results_nonkf["mean_psnr"]],
-        "ssim": [results_kf["mean_ssim"], results_nonkf["mean_ssim"]],
-        "lpips": [results_kf["mean_lpips"], results_nonkf["mean_lpips"]],
-        "extra_non_kf": [
-            str(cfg.mapping.refinement.sampling.use_non_keyframes),
-            str(cfg.mapping.refinement.sampling.use_non_keyframes),
-        ],
-        "eval_on_keyframes": [True, False],
+    return [
+        {"ate_on_keyframes_only": True, **shared, "ape": results_kf["mean"], "ate": results_kf["rmse"]},
+        {"ate_on_keyframes_only": False, **shared, "ape": results_all["mean"], "ate": results_all["rmse"]},
+    ]
+
+
+def create_rendering_csv(results_kf, results_nonkf, cfg: DictConfig, input_path: str) -> List[Dict]:
+    shared = {
+        "run_backend": cfg.run_backend,
+        "run_mapping": cfg.run_mapping,
+        "stride": cfg.stride,
+        "loop_closure": cfg.tracking.backend.use_loop_closure,
+        "loop_detector": cfg.run_loop_detection,
+        "dataset": input_path,
+        "mode": cfg.mode,
     }
-    return csv_dict
+    rows = []
+    for results, on_keyframes in [(results_kf, True), (results_nonkf, False)]:
+        row = {
+            **shared,
+            "psnr": results["mean_psnr"],
+            "ssim": results["mean_ssim"],
+            "lpips": results["mean_lpips"],
+            "extra_non_kf": cfg.mapping.refinement.sampling.use_non_keyframes,
+            "eval_on_keyframes": on_keyframes,
+        }
+        rows.append(row)
+    return rows
 
 
 ### Odometry ###
@@ -141,6 +140,13 @@ def evaluate_evo(
 
     NOTE The plotting functionality of evo expects c2w convention.
     """
+    # NOTE evo and matplotlib are heavy to import, we only need them when actually evaluating
+    import matplotlib.pyplot as plt
+    from evo.core import metrics, sync
+
+    # NOTE chen: MonoGS uses PosePath3D, everyone else uses PoseTrajectory3D which seems more compatible with our video structure
+    from evo.core.trajectory import PoseTrajectory3D
+    from evo.tools.plot import PlotMode, prepare_axis, traj, traj_colormap
 
     plot_dir = os.path.join(save_dir, "plots")
     mkdir_p(plot_dir)
@@ -178,8 +184,8 @@ def evaluate_evo(
     for key, value in ape_stats.items():
         ape_stats[key] = float(value)
 
-    with open(os.path.join(save_dir, "stats_{}.json".format(str(label))), "w", encoding="utf-8") as f:
-        json.dump(ape_stats, f, indent=4)
+    with open(os.path.join(save_dir, "stats_{}.json".format(str(label))), "wb") as f:
+        f.write(orjson.dumps(ape_stats, option=orjson.OPT_INDENT_2))
 
     plot_mode = PlotMode.xy
     fig = plt.figure()
@@ -205,27 +211,13 @@ def get_gt_c2w_from_stream(stream) -> torch.Tensor:
     """Get all 4x4 homogenous matrices in c2w format from the dataset stream.
     We transform these into a (N x 7 x 1) lie vector.
     """
-    poses = np.stack(stream.poses)
-    if np.isnan(poses).any() or np.isinf(poses).any():
+    poses = np.asarray(stream.poses, dtype=np.float32)
+    # NOTE isfinite checks for both NaN and Inf in a single pass
+    if not np.isfinite(poses).all():
         raise Exception(colored(f"Error. Nan or Inf found in gt poses!", "red"))
     return matrix_to_lie(torch.from_numpy(poses))
 
 
-def get_odometry_from_video(video: DepthVideo) -> torch.Tensor:
-    """Extract the whole odometry from the video object for both our estimated poses and the groundtruth"""
-
-    trj_est, trj_gt = [], []
-    for i in range(video.counter.value):
-        _, _, _, _, c2w_est, _ = video.get_mapping_item(i, use_gt=False, device=video.device)
-        _, _, _, _, c2w_gt, _ = video.get_mapping_item(i, use_gt=True, device=video.device)
-        if torch.abs(c2w_gt.vec().sum()) < 1e-7:
-            raise ValueError("Groundtruth pose is zero. Video object likely does not have any gt poses!")
-        trj_est.append(c2w_est.vec().detach().cpu().numpy())
-        trj_gt.append(c2w_gt.vec().detach().cpu().numpy())
-
-    return np.stack(trj_est), np.stack(trj_gt)
-
-
 def write_out_kitti_style(
     traj: List[np.ndarray] | np.ndarray, poses_in: str = "matrix", outfile: str = "test.txt"
 ) -> None:
@@ -236,23 +228,17 @@ def write_out_kitti_style(
         i j k l
         0 0 0 1
     """
-    with open(outfile, "w") as f:
-        for pose in traj:
-            if poses_in == "matrix":
-                pose = pose.flatten()
-            elif poses_in == "lie":
-                pose = SE3.InitFromVec(torch.from_numpy(pose)).matrix().numpy().flatten()
-            else:
-                raise Exception(
-                    "Unknown pose format! Please provide them either as a 4x4 homogeneous matrix or as a 7x1 lie element"
-                )
-
-            for i in range(12):
-                if i == 11:
-                    f.write(str(pose[i]))  # Dont leave a trailing space
-                else:
-                    f.write(str(pose[i]) + " ")
-            f.write("\n")
+    # NOTE asarray does not copy if we already get a stacked array
+    if poses_in == "matrix":
+        poses = np.asarray(traj)
+    elif poses_in == "lie":
+        poses = lie_to_matrix(torch.as_tensor(np.asarray(traj))).numpy()
+    else:
+        raise Exception(
+            "Unknown pose format! Please provide them either as a 4x4 homogeneous matrix or as a 7x1 lie element"
+        )
+    poses = poses.reshape(len(poses), 4, 4)[:, :3, :4].reshape(len(poses), 12)
+    np.savetxt(outfile, poses, fmt="%.18e", delimiter=" ")
 
 
 def eval_ate(
@@ -276,9 +262,10 @@ def eval_ate(
     assert len(timestamps) == len(traj_est), "Timestamps should have the same length as the trajectories!"
 
     # Write out serialized string to read later
-    trj_data = {"trj_est": traj_est.tolist(), "trj_gt": traj_gt.tolist()}
-    with open(os.path.join(save_dir, f"trj_final.json"), "w", encoding="utf-8") as f:
-        json.dump(trj_data, f, indent=4)
+    # NOTE orjson serializes the numpy buffers directly without creating Python lists first
+    trj_data = {"trj_est": np.ascontiguousarray(traj_est), "trj_gt": np.ascontiguousarray(traj_gt)}
+    with open(os.path.join(save_dir, f"trj_final.json"), "wb") as f:
+        f.write(orjson.dumps(trj_data, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_INDENT_2))
     ate = evaluate_evo(
         poses_est=traj_est,
         poses_gt=traj_gt,
@@ -293,87 +280,103 @@ def eval_ate(
 ### Rendering ###
 
 
-def create_comparison_figure(
+@lru_cache(maxsize=None)
+def get_colormap_lut(cmap: str = "Spectral") -> np.ndarray:
+    """Sample a matplotlib colormap into a [256, 1, 3] BGR lookup table, which we can use with cv2.applyColorMap."""
+    from matplotlib import colormaps
+
+    lut = colormaps[cmap](np.linspace(0.0, 1.0, 256))[:, :3]
+    return (lut[:, None, ::-1] * 255).astype(np.uint8)
+
+
+def depth_to_colormap(depth: np.ndarray, min_depth: float, max_depth: float, cmap: str = "Spectral") -> np.ndarray:
+    """Normalize a depth map to [min_depth, max_depth] and color it with a colormap, returns a BGR image."""
+    depth = (depth.squeeze() - min_depth) / max(max_depth - min_depth, 1e-8)
+    depth = (np.clip(depth, 0.0, 1.0) * 255).astype(np.uint8)
+    return cv2.applyColorMap(depth, get_colormap_lut(cmap))
+
+
+def save_comparison_png(
+    path: str,
     gt_img: np.ndarray,
     est_img: np.ndarray,
     gt_depth: Optional[np.ndarray] = None,
     est_depth: Optional[np.ndarray] = None,
-) -> plt.Figure:
-    """Create a plot with both gt and estimate images side by side"""
-
+) -> None:
+    """Tile gt and estimate images side by side and write them directly with cv2. If depth is given, we add
+    a second row with both depths in a shared color range. Images are expected in cv2 BGR order.
+    """
     # Sanity
     assert gt_img.shape == est_img.shape, "Both images should have the same shape!"
     assert gt_img.dtype == est_img.dtype, "Both images should have the same dtype!"
+
+    tiled = np.hstack([gt_img.squeeze(), est_img.squeeze()])
     if gt_depth is not None:
         assert est_depth is not None, "Both gt and estimated depth should be provided!"
-
-        fig, axes = plt.subplots(2, 2, figsize=(10, 5))
-        # Display the ground truth image
-        axes[0, 0].imshow(gt_img.squeeze()[..., ::-1])
-        axes[0, 0].set_title("Ground Truth")
-        axes[0, 0].axis("off")
-
-        # Display the predicted image
-        axes[0, 1].imshow(est_img.squeeze()[..., ::-1])
-        axes[0, 1].set_title("Prediction")
-        axes[0, 1].axis("off")
-
         min_depth = min(gt_depth.min(), est_depth.min())
         max_depth = max(gt_depth.max(), est_depth.max())
-
-        # Display the gt depth
-        axes[1, 0].imshow(gt_depth.squeeze(), cmap="Spectral", vmin=min_depth, vmax=max_depth)
-        axes[1, 0].set_title("Groundtruth")
-        axes[1, 0].axis("off")
-
-        # Display the predicted depth
-        axes[1, 1].imshow(est_depth.squeeze(), cmap="Spectral", vmin=min_depth, vmax=max_depth)
-        axes[1, 1].set_title("Prediction")
-        axes[1, 1].axis("off")
-
-    else:
-        fig, axes = plt.subplots(1, 2, figsize=(10, 5))
-
-        # Display the ground truth image
-        axes[0].imshow(gt_img.squeeeze())
-        axes[0].set_title("Ground Truth")
-        axes[0].axis("off")
-
-        # Display the predicted image
-        axes[1].imshow(est_img.squeeze())
-        axes[1].set_title("Prediction")
-        axes[1].axis("off")
-
-    return fig
+        bottom = np.hstack(
+            [depth_to_colormap(gt_depth, min_depth, max_depth), depth_to_colormap(est_depth, min_depth, max_depth)]
+        )
+        tiled = np.vstack([tiled, bottom])
+    cv2.imwrite(path, tiled)
 
 
-def save_dense_predictions(
-    save_dir: str, idx: int, est_depth: torch.Tensor, est_img: torch.Tensor, gt_depth: Optional[torch.Tensor] = None
-) -> None:
-    fig1, ax1 = plt.subplots(1, 1)
-    # Display the ground truth image
-    ax1.imshow(est_img.squeeze()[..., ::-1])
-    ax1.axis("off")
-    fig1.tight_layout()
-
-    fig2, ax2 = plt.subplots(1, 1)
-    # Display the ground truth image
-    if gt_depth is not None:
-        min_depth, max_depth = gt_depth.min(), gt_depth.max()
-    else:
-        min_depth, max_depth = est_depth.min(), est_depth.max()
-    ax2.imshow(est_depth.squeeze(), cmap="Spectral", vmin=min_depth, vmax=max_depth)
-    ax2.axis("off")
-    fig2.tight_layout()
+class DensePredictionPlotter:
+    """Keeps a persistent image and depth figure for saving our dense predictions. Creating a new matplotlib figure
+    and its axes layout is expensive, so we only update the image data per frame and rebuild when the resolution changes.
+    """
 
-    fig1.savefig(os.path.join(save_dir, f"est_img_{str(idx).zfill(4)}.png"))
-    fig2.savefig(os.path.join(save_dir, f"est_depth_{str(idx).zfill(4)}.png"))
-    plt.close(fig1)
-    plt.close(fig2)
+    def __init__(self):
+        self.lock = threading.Lock()  # matplotlib is not made for drawing concurrently
+        self.shape = None
+        self.fig_img, self.fig_depth = None, None
+        self.im_img, self.im_depth = None, None
+
+    def _make_figures(self, est_img: np.ndarray, est_depth: np.ndarray) -> None:
+        from matplotlib.figure import Figure
+
+        self.fig_img = Figure()
+        ax1 = self.fig_img.subplots(1, 1)
+        self.im_img = ax1.imshow(est_img)
+        ax1.axis("off")
+        self.fig_img.tight_layout()
+
+        self.fig_depth = Figure()
+        ax2 = self.fig_depth.subplots(1, 1)
+        self.im_depth = ax2.imshow(est_depth, cmap="Spectral")
+        ax2.axis("off")
+        self.fig_depth.tight_layout()
+        self.shape = est_img.shape
+
+    def save(
+        self,
+        save_dir: str,
+        idx: int,
+        est_depth: np.ndarray,
+        est_img: np.ndarray,
+        gt_depth: Optional[np.ndarray] = None,
+    ) -> None:
+        est_img, est_depth = est_img.squeeze()[..., ::-1], est_depth.squeeze()
+        if gt_depth is not None:
+            min_depth, max_depth = gt_depth.min(), gt_depth.max()
+        else:
+            min_depth, max_depth = est_depth.min(), est_depth.max()
+
+        with self.lock:
+            if est_img.shape != self.shape:
+                self._make_figures(est_img, est_depth)
+            self.im_img.set_data(est_img)
+            self.im_depth.set_data(est_depth)
+            self.im_depth.set_clim(min_depth, max_depth)
+
+            self.fig_img.savefig(os.path.join(save_dir, f"est_img_{str(idx).zfill(4)}.png"))
+            self.fig_depth.savefig(os.path.join(save_dir, f"est_depth_{str(idx).zfill(4)}.png"))
 
 
 def plot_metric_statistics(psnr_array, ssim_array, lpips_array, plot_dir: str):
     """1 bar plot per metric"""
+    import matplotlib.pyplot as plt
 
     frames = np.arange(len(psnr_array))
 
@@ -401,24 +404,20 @@ def save_gaussians(gaussians: GaussianModel, save_dir: str, iteration: Optional[
     gaussians.save_ply(os.path.join(point_cloud_path, "point_cloud.ply"))
 
 
-def torch_intersect1d(t1: torch.Tensor, t2: torch.Tensor):
-    assert t1.dim() == 1 and t2.dim() == 1, "t1, t2 should be 1D Tensors"
-    # NOTE: requires t1, t2 to be unique 1D Tensor in advance.
-    # Method: based on unique's count
-    num_t1, num_t2 = t1.numel(), t2.numel()
-    u, inv, cnt = torch.unique(torch.cat([t1, t2]), return_counts=True, return_inverse=True)
-
-    cnt_12 = cnt[inv]
-    cnt_t1, cnt_t2 = cnt_12[:num_t1], cnt_12[num_t1:]
-    m_t1 = cnt_t1 == 2
-    inds_t1 = m_t1.nonzero()[..., 0]
-    inds_t1_exclusive = (~m_t1).nonzero()[..., 0]
-    inds_t2_exclusive = (cnt_t2 == 1).nonzero()[..., 0]
+def sorted_setdiff(ids: List[int], exclude: List[int]) -> List[int]:
+    """Return all ids that are not in exclude, while keeping their order.
 
-    intersection = t1[inds_t1]
-    t1_exclusive = t1[inds_t1_exclusive]
-    t2_exclusive = t2[inds_t2_exclusive]
-    return intersection, t1_exclusive, t2_exclusive
+    NOTE this requires ids to be sorted and unique, e.g. frame timestamps. This lets us locate the excluded ids
+    with a binary search and build a mask instead of sorting both arrays again.
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    exclude = np.asarray(exclude, dtype=np.int64)
+    keep = np.ones(len(ids), dtype=bool)
+    pos = np.searchsorted(ids, exclude)
+    in_range = pos < len(ids)
+    pos, exclude = pos[in_range], exclude[in_range]
+    keep[pos[ids[pos] == exclude]] = False
+    return ids[keep].tolist()
 
 
 def do_odometry_evaluation(
@@ -437,8 +436,7 @@ def do_odometry_evaluation(
     mkdir_p(kf_eval_path)
 
     kf_result_ate = eval_ate(est_c2w_kf_lie, gt_c2w_kf_lie, kf_tstamps, save_dir=kf_eval_path, monocular=monocular)
-    kf_trajectory_df = pd.DataFrame([kf_result_ate])
-    kf_trajectory_df.to_csv(os.path.join(kf_eval_path, "kf_trajectory_results.csv"), index=False)
+    write_csv([kf_result_ate], os.path.join(kf_eval_path, "kf_trajectory_results.csv"))
     # NOTE chen: you can use this file to directly visualize the trajectory using evo
     write_out_kitti_style(est_c2w_kf_lie, poses_in="lie", outfile=os.path.join(kf_eval_path, "kf_est_c2w.txt"))
 
@@ -447,8 +445,7 @@ def do_odometry_evaluation(
     mkdir_p(all_eval_path)
 
     all_result_ate = eval_ate(est_c2w_all_lie, gt_c2w_all_lie, tstamps, save_dir=all_eval_path, monocular=monocular)
-    all_trajectory_df = pd.DataFrame([all_result_ate])
-    all_trajectory_df.to_csv(os.path.join(all_eval_path, "all_trajectory_results.csv"), index=False)
+    write_csv([all_result_ate], os.path.join(all_eval_path, "all_trajectory_results.csv"))
     # NOTE chen: you can use this file to directly visualize the trajectory using evo
     write_out_kitti_style(est_c2w_all_lie, poses_in="lie", outfile=os.path.join(all_eval_path, "est_c2w.txt"))
     return kf_result_ate, all_result_ate
@@ -487,6 +484,62 @@ def compute_scale_and_shift(prediction: torch.Tensor, target: torch.Tensor, mask
     return x_0.squeeze().float(), x_1.squeeze().float()
 
 
+@torch.no_grad()
+def compute_image_metrics(images_est: torch.Tensor, images_gt: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Compute PSNR and SSIM for a batch of images [B, 3, H, W] with a single call per metric.
+    PSNR is only computed on valid pixels, where the groundtruth is non-zero.
+
+    returns:
+    ---
+    psnr, ssim: [B] scores per frame, which stay on the device so we dont need to synchronize
+    """
+    # NOTE we keep both metrics in float32, SSIM subtracts local moments of similar size and is very sensitive to precision
+    # NOTE this is the same as psnr() on the masked pixels, but a dense reduction avoids the boolean gather
+    valid = (images_gt > 0).float()
+    mse = (((images_est - images_gt) ** 2) * valid).sum(dim=(1, 2, 3)) / valid.sum(dim=(1, 2, 3)).clamp_min(1)
+    psnr_scores = -10 * torch.log10(mse)
+    ssim_scores = ssim(images_est, images_gt, size_average=False)
+    return psnr_scores, ssim_scores
+
+
+def compute_image_metrics_async(
+    images_est: List[torch.Tensor], images_gt: List[torch.Tensor], stream: torch.cuda.Stream
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Run compute_image_metrics() for a list of frames on a side stream, so it overlaps with rendering the next frames.
+    Make sure to synchronize with the stream before reading out the results!
+    """
+    stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(stream):
+        # The inputs were allocated on the default stream, dont let the allocator reuse them while the metrics are running
+        for image in images_est + images_gt:
+            image.record_stream(stream)
+        return compute_image_metrics(torch.stack(images_est), torch.stack(images_gt))
+
+
+@torch.no_grad()
+def compute_lpips(
+    images_est: List[torch.Tensor],
+    images_gt: List[torch.Tensor],
+    cal_lpips: "LearnedPerceptualImagePatchSimilarity",
+    use_autocast: bool = True,
+) -> torch.Tensor:
+    """Compute LPIPS for a chunk of frames [3, H, W]. With use_autocast, the network runs in bfloat16.
+
+    returns:
+    ---
+    lpips: [N] scores per frame
+    """
+    lpips_scores = []
+    for est, gt in zip(images_est, images_gt):
+        # NOTE AlexNet is robust to reduced precision, we only report LPIPS up to a few decimals anyways
+        with torch.autocast(device_type="cuda", dtype=torch.bfloat16, enabled=use_autocast):
+            # NOTE the metric reduces over the batch, so we call it per frame to get scores per frame
+            score = cal_lpips(est.unsqueeze(0).float(), gt.unsqueeze(0).float())
+        lpips_scores.append(score.float().view(1))
+    return torch.cat(lpips_scores)
+
+
+@torch.inference_mode()
 def eval_rendering(
     cams: List[Camera],
     tstamps: List[int],
@@ -499,6 +552,7 @@ def eval_rendering(
     monocular: bool = True,
     save_renders: bool = True,
     save_predictions: bool = True,
+    metric_batch_size: int = 8,
 ):
     """Evaluate the rendering quality of the estimated Scene model and Camera poses by comparing with the dataset groundtruth.
 
@@ -507,11 +561,31 @@ def eval_rendering(
     estimates.
 
     If monocular, we will compute a scale-invariant l1 loss between the rendered depth and gt depth, otherwise we directly compare the depths.
+
+    NOTE this runs in inference mode, since we never need gradients for rendering or metrics here.
+    PSNR, SSIM and LPIPS are computed in chunks of metric_batch_size frames while rendering, so we only keep a chunk on the GPU.
+    Metrics run on a separate CUDA stream and plots are written out in a background thread pool.
     """
     # Collect all the frames
-    img_pred, img_gt, depth_pred, depth_gt, saved_frame_idx = [], [], [], [], []
-    psnr_array, ssim_array, lpips_array, depth_l1 = [], [], [], []
+    saved_frame_idx = []
+    psnr_scores, ssim_scores, lpips_scores = [], [], []
+    batch_est, batch_gt = [], []
+    n_frames = 0
+    from torchmetrics.image.lpip import LearnedPerceptualImagePatchSimilarity
+
+    # NOTE gsplat is an optional dependency and only used for this forward-only path
+    use_gsplat = render_pipeline_cfg.get("eval_with_gsplat", False)
+    if use_gsplat and not HAS_GSPLAT:
+        print(colored("[Evaluation] Warning: gsplat is not installed, falling back to default rasterizer!", "red"))
+        use_gsplat = False
+
     cal_lpips = LearnedPerceptualImagePatchSimilarity(net_type="alex", normalize=True).to("cuda")
+    cal_lpips.eval().requires_grad_(False)
+    # NOTE PNG encoding releases the GIL, so we can write multiple frames concurrently while we keep rendering
+    save_pool = ThreadPoolExecutor(max_workers=4)
+    metric_stream = torch.cuda.Stream()
+    prediction_plotter = DensePredictionPlotter()
+    save_jobs = []
 
     dataset.return_stat_masks = False  # Dont return dynamic object masks here
     if dataset.depth_paths is not None and len(dataset.depth_paths) > 0:
@@ -524,45 +598,57 @@ def eval_rendering(
     mkdir_p(save_dir)
     mkdir_p(plot_dir)
 
-    for i, idx in tqdm(enumerate(tstamps)):
-
-        if i % save_every != 0:
-            continue
+    # Load the groundtruth in background workers into pinned memory, so we can upload it asynchronously
+    eval_ids = list(range(0, len(tstamps), save_every))
+    depth_l1_scores = torch.empty(len(eval_ids), device="cuda")
+    gt_loader = DataLoader(
+        Subset(dataset, [tstamps[i] for i in eval_ids]),
+        batch_size=1,
+        num_workers=2,
+        pin_memory=True,
+        collate_fn=collate_single_item,
+    )
 
+    for i, (_, gt_image, gt_depth, _, _) in tqdm(zip(eval_ids, gt_loader), total=len(eval_ids)):
+        idx = tstamps[i]
         saved_frame_idx.append(idx)
         cam = cams[i]  # NOTE chen: Make sure that the order of tstamps and cams is the same and corresponding!
         # NOTE we detach tensors to the CPU, because for some scenes we have a lot of images and we want to save memory
         cam.image_tensors_to("cuda")  # Make sure everything is on the GPU for Rendering
-        _, gt_image, gt_depth, _, _ = dataset[idx]
-        gt_image = gt_image.squeeze(0)
+        gt_image = gt_image.squeeze(0).to("cuda", non_blocking=True)
         if has_gt_depth:
-            gt_depth = gt_depth.squeeze(0)
+            gt_depth = gt_depth.squeeze(0).to("cuda", non_blocking=True)
 
-        render_dict = render(cam, gaussians, render_pipeline_cfg, background)
+        if use_gsplat:
+            render_dict = render_gsplat(cam, gaussians, background)
+        else:
+            render_dict = render(cam, gaussians, render_pipeline_cfg, background)
         image_est, depth_est = render_dict["render"], render_dict["depth"]
         image_est = torch.clamp(image_est, 0.0, 1.0)
 
         ## Conversion
-        gt_img_np = (gt_image.cpu().numpy().transpose((1, 2, 0)) * 255).astype(np.uint8)
-        est_img_np = (image_est.detach().cpu().numpy().transpose((1, 2, 0)) * 255).astype(np.uint8)
-        gt_img_np = cv2.cvtColor(gt_img_np, cv2.COLOR_BGR2RGB)  # Convert to RGB since we load images with cv2
-        est_img_np = cv2.cvtColor(est_img_np, cv2.COLOR_BGR2RGB)
-        img_pred.append(est_img_np)
-        img_gt.append(gt_img_np)
-        # If we have groundtruth depth
-        if has_gt_depth:
-            depth_est, gt_depth = depth_est.detach().cpu(), gt_depth.cpu()
-            depth_pred.append(depth_est)
-            depth_gt.append(gt_depth)
+        # NOTE we keep a single copy of the render and depth on the GPU for the metrics and only download it when plotting
+        if save_renders or save_predictions:
+            # Swap to cv2 channel order on the GPU
+            gt_img_np = gt_image[[2, 1, 0]].mul(255).byte().permute(1, 2, 0).cpu().numpy()
+            est_img_np = image_est.detach().mul(255).byte().permute(1, 2, 0).cpu().numpy()
+            est_img_np = est_img_np[..., ::-1]  # View in cv2 channel order, plotting and tiling dont need a copy
 
         ### Plot a comparison for inspection
         if save_renders:
+            plot_path = os.path.join(plot_dir, "rendered_vs_gt_" + str(idx) + ".png")
             if has_gt_depth:
-                fig = create_comparison_figure(gt_img_np, est_img_np, gt_depth.cpu().numpy(), depth_est.cpu().numpy())
+                job = save_pool.submit(
+                    save_comparison_png,
+                    plot_path,
+                    gt_img_np,
+                    est_img_np,
+                    gt_depth.cpu().numpy(),
+                    depth_est.cpu().numpy(),
+                )
             else:
-                fig = create_comparison_figure(gt_img_np, est_img_np)
-            plt.savefig(os.path.join(plot_dir, "rendered_vs_gt_" + str(idx) + ".png"))
-            plt.close(fig)
+                job = save_pool.submit(save_comparison_png, plot_path, gt_img_np, est_img_np)
+            save_jobs.append(job)
         if save_predictions:
             if has_gt_depth:
                 if monocular:
@@ -572,21 +658,22 @@ def eval_rendering(
                     depth_est_visu = (depth_est * scale + shift).cpu().numpy()
                 else:
                     depth_est_visu = depth_est.cpu().numpy()
-                save_dense_predictions(save_dir, idx, depth_est_visu, est_img_np, gt_depth.cpu().numpy())
+                job = save_pool.submit(
+                    prediction_plotter.save, save_dir, idx, depth_est_visu, est_img_np, gt_depth.cpu().numpy()
+                )
             else:
-                save_dense_predictions(save_dir, idx, depth_est.cpu().numpy(), est_img_np)
+                job = save_pool.submit(prediction_plotter.save, save_dir, idx, depth_est.cpu().numpy(), est_img_np)
+            save_jobs.append(job)
 
         ### Image similarity metrics
-        valid_img = gt_image > 0
-        psnr_score = psnr(
-            (image_est[valid_img]).unsqueeze(0).to("cuda"), (gt_image[valid_img]).unsqueeze(0).to("cuda")
-        )
-        ssim_score = ssim((image_est).unsqueeze(0).to("cuda"), (gt_image).unsqueeze(0).to("cuda"))
-        lpips_score = cal_lpips((image_est).unsqueeze(0).to("cuda"), (gt_image).unsqueeze(0).to("cuda"))
-        # Gather scores
-        psnr_array.append(psnr_score.item())
-        ssim_array.append(ssim_score.item())
-        lpips_array.append(lpips_score.item())
+        batch_est.append(image_est.detach())
+        batch_gt.append(gt_image)
+        if len(batch_est) == metric_batch_size:
+            batch_psnr, batch_ssim = compute_image_metrics_async(batch_est, batch_gt, metric_stream)
+            psnr_scores.append(batch_psnr)
+            ssim_scores.append(batch_ssim)
+            lpips_scores.append(compute_lpips(batch_est, batch_gt, cal_lpips))
+            batch_est, batch_gt = [], []
 
         ### Depth Similarity metrics
         if has_gt_depth:
@@ -595,15 +682,42 @@ def eval_rendering(
                 loss_func = ScaleAndShiftInvariantLoss()
             else:
                 loss_func = l1_loss
-            depth_loss = loss_func(depth_est, gt_depth, mask=valid_depth)
-            depth_l1.append(depth_loss.item())
+            depth_l1_scores[n_frames] = loss_func(depth_est, gt_depth, mask=valid_depth)
+
+        n_frames += 1
+
+    # Flush the remaining frames
+    if len(batch_est) > 0:
+        batch_psnr, batch_ssim = compute_image_metrics_async(batch_est, batch_gt, metric_stream)
+        psnr_scores.append(batch_psnr)
+        ssim_scores.append(batch_ssim)
+        lpips_scores.append(compute_lpips(batch_est, batch_gt, cal_lpips))
+    torch.cuda.current_stream().wait_stream(metric_stream)
+    # Read out all scores with a single synchronization
+    psnr_array, ssim_array = np.empty(n_frames, dtype=np.float32), np.empty(n_frames, dtype=np.float32)
+    lpips_array = np.empty(n_frames, dtype=np.float32)
+    # NOTE eval_ids can be empty, e.g. when save_every is larger than the number of frames
+    if n_frames > 0:
+        psnr_array[:] = torch.cat(psnr_scores).cpu().numpy()
+        ssim_array[:] = torch.cat(ssim_scores).cpu().numpy()
+        lpips_array[:] = torch.cat(lpips_scores).cpu().numpy()
+    else:
+        print(colored("[Evaluation] Warning: No frames to evaluate, all metrics will be NaN!", "red"))
+    if has_gt_depth:
+        depth_l1 = depth_l1_scores[:n_frames].cpu().numpy()
+
+    # Make sure all plots are written before we return
+    for job in save_jobs:
+        job.result()
+    save_pool.shutdown()
 
-    plot_metric_statistics(psnr_array, ssim_array, lpips_array, plot_dir)
+    if n_frames > 0:
+        plot_metric_statistics(psnr_array, ssim_array, lpips_array, plot_dir)
 
     output = dict()
-    output["mean_psnr"] = float(np.mean(psnr_array))
-    output["mean_ssim"] = float(np.mean(ssim_array))
-    output["mean_lpips"] = float(np.mean(lpips_array))
+    output["mean_psnr"] = float(psnr_array.mean())
+    output["mean_ssim"] = float(ssim_array.mean())
+    output["mean_lpips"] = float(lpips_array.mean())
 
     # Print this in pretty so we can see it
     loss_str = "[Eval] mean PSNR: {}, SSIM: {}, LPIPS: {}".format(
@@ -611,12 +725,13 @@ def eval_rendering(
     )
     rnd_statistics = {"psnr": psnr_array, "ssim": ssim_array, "lpips": lpips_array}
     if has_gt_depth:
-        output["mean_l1"] = float(np.mean(depth_l1))
+        output["mean_l1"] = float(depth_l1.mean())
         loss_str += ", L1 (depth): {}".format(output["mean_l1"])
         rnd_statistics["l1"] = depth_l1
     print(colored(loss_str, "red"))
 
     with open(os.path.join(save_dir, "frame_statistics.pkl"), "wb") as f:
         pickle.dump(rnd_statistics, f)
-    json.dump(output, open(os.path.join(save_dir, "final_result.json"), "w", encoding="utf-8"), indent=4)
+    with open(os.path.join(save_dir, "final_result.json"), "wb") as f:
+        f.write(orjson.dumps(output, option=orjson.OPT_INDENT_2))
     return output
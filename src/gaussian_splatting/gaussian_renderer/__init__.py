@@ -17,6 +17,13 @@ import torch
 import math
 from diff_gaussian_rasterization import GaussianRasterizationSettings, GaussianRasterizer
 
+try:
+    from gsplat import rasterization
+
+    HAS_GSPLAT = True
+except ImportError:
+    HAS_GSPLAT = False
+
 from ..scene.gaussian_model import GaussianModel
 from ..utils.sh_utils import eval_sh
 
@@ -161,3 +168,49 @@ def render(
         "opacity": opacity,
         "n_touched": n_touched,
     }
+
+
+@torch.no_grad()
+def render_gsplat(viewpoint_camera, pc: GaussianModel, bg_color: torch.Tensor, device: str = "cuda"):
+    """
+    Render the scene with the gsplat rasterizer. This is only a forward pass for evaluation, since we do not
+    get the pose gradients of our own rasterizer here.
+
+    Returns the same "render" and "depth" entries as render(), so both can be used interchangeably during evaluation.
+    """
+    if len(pc.get_xyz) == 0:
+        return None
+
+    height, width = int(viewpoint_camera.image_height), int(viewpoint_camera.image_width)
+    fx, fy = float(viewpoint_camera.fx), float(viewpoint_camera.fy)
+    cx, cy = float(viewpoint_camera.cx), float(viewpoint_camera.cy)
+    Ks = torch.tensor([[fx, 0.0, cx], [0.0, fy, cy], [0.0, 0.0, 1.0]], device=device)
+    # NOTE world_view_transform is stored transposed for the CUDA rasterizer
+    viewmats = viewpoint_camera.world_view_transform.transpose(0, 1)
+
+    scales = pc.get_scaling
+    if scales.shape[-1] == 1:  # isotropic Gaussians
+        scales = scales.repeat(1, 3)
+
+    render_colors, render_alphas, _ = rasterization(
+        means=pc.get_xyz,
+        quats=pc.get_rotation,
+        scales=scales,
+        opacities=pc.get_opacity.squeeze(-1),
+        colors=pc.get_features,
+        viewmats=viewmats[None],
+        Ks=Ks[None],
+        width=width,
+        height=height,
+        sh_degree=pc.active_sh_degree,
+        render_mode="RGB+D",
+    )
+    rgb, depth = render_colors[0].split([3, 1], dim=-1)
+    alpha = render_alphas[0]
+    rgb = rgb + (1.0 - alpha) * bg_color.view(1, 1, 3)  # Composite the background like our own rasterizer
+
+    return {
+        "render": rgb.permute(2, 0, 1),
+        "depth": depth.permute(2, 0, 1),
+        "opacity": alpha.permute(2, 0, 1),
+    }
@@ -1,6 +1,5 @@
 from typing import Tuple
 from termcolor import colored
-import ipdb
 
 import torch
 import lietorch
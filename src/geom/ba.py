@@ -1,14 +1,15 @@
-import ipdb
-from typing import Optional
+import functools
+from typing import Optional, Tuple
 from termcolor import colored
 
 import torch
-from einops import rearrange, einsum, reduce
-from torch_scatter import scatter_sum
+import torch._dynamo
+from einops import rearrange, reduce
 
 from .chol import (
     schur_solve,
     schur_block_solve,
+    schur_solve_block_diagonal,
     cholesky_block_solve,
     CholeskySolver,
     LUSolver,
@@ -77,6 +78,107 @@ In case we detect an overflow, we simply clip the Jacobians / Gradients, which e
 # TODO we can use unsqueeze and squeeze! correct again for better readability
 
 
+def compile_with_fallback(fn=None, **compile_kwargs):
+    """Compile a function with TorchInductor, so its long chains of reshapes, pointwise ops and small matmuls
+    are fused into fewer kernels. Shapes change with the factor graph, so we compile with dynamic shapes.
+    Additional arguments like mode="reduce-overhead" are passed to torch.compile().
+
+    If compilation is not supported on this setup, we fall back to eager mode and stay there.
+    NOTE we only catch compilation failures, these happen before the graph runs and therefore before any of the
+    in-place updates. Runtime errors like OOM or shape mismatches are raised as usual.
+    """
+    if fn is None:
+        return functools.partial(compile_with_fallback, **compile_kwargs)
+
+    try:
+        compiled = torch.compile(fn, dynamic=True, **compile_kwargs)
+    except RuntimeError:
+        compiled = None
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        nonlocal compiled
+        if compiled is not None:
+            try:
+                return compiled(*args, **kwargs)
+            except (torch._dynamo.exc.BackendCompilerFailed, torch._dynamo.exc.Unsupported) as e:
+                print(colored(f"Warning. Could not compile {fn.__name__}, running in eager mode: {e}", "red"))
+                compiled = None
+        return fn(*args, **kwargs)
+
+    return wrapper
+
+
+@functools.lru_cache(maxsize=None)
+def supports_bf16_tensor_cores(device: torch.device) -> bool:
+    """Check if the device has bfloat16 tensor cores, i.e. is an Ampere GPU or newer."""
+    return device.type == "cuda" and torch.cuda.get_device_capability(device) >= (8, 0)
+
+
+def compile_with_graph_cap(fn, max_graphs: int = 8):
+    """Compile a function as CUDA graph ("reduce-overhead") for the first max_graphs input shapes it sees and with the
+    default mode for all other shapes. Every new shape records its own graph with its own memory, which would otherwise
+    keep growing with the number of window sizes over a long sequence.
+    """
+    graph_fn = compile_with_fallback(fn, mode="reduce-overhead")
+    default_fn = compile_with_fallback(fn)
+    graph_shapes = set()
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        shapes = tuple(tuple(arg.shape) for arg in args if isinstance(arg, torch.Tensor))
+        if shapes not in graph_shapes and len(graph_shapes) < max_graphs:
+            graph_shapes.add(shapes)
+        if shapes in graph_shapes:
+            return graph_fn(*args, **kwargs)
+        return default_fn(*args, **kwargs)
+
+    return wrapper
+
+
+# NOTE we cannot capture a whole BA iteration into a CUDA graph, since the window nodes have data dependent shapes and
+# reweighting the prior synchronizes with the CPU. The per-frame solve on the other hand is a pure function of fixed
+# shapes for a given window, so we let the compiler capture and replay it as a CUDA graph ("reduce-overhead").
+# The outputs of a replayed graph are overwritten by the next replay, so they need to be consumed right away!
+solve_prior_system = compile_with_graph_cap(schur_solve_block_diagonal)
+
+
+# NOTE each process of the system has its own copy of this cache, so buffers are never shared between frontend and backend
+_buffer_cache = {}
+
+
+def get_buffer(name: str, shape: Tuple[int, ...], device: torch.device, dtype: torch.dtype) -> torch.Tensor:
+    """Get an uninitialized buffer, which is reused across calls with the same shape instead of allocating a new one.
+    The window [t0, t1] only changes when new keyframes come in, so the same shapes repeat over many iterations.
+
+    NOTE the buffer is overwritten on the next call with the same name and shape, so never return it to the caller!
+    """
+    key = (name, tuple(shape), device, dtype)
+    buffer = _buffer_cache.get(key)
+    if buffer is None:
+        # Dont keep buffers of old windows around forever
+        if len(_buffer_cache) > 32:
+            _buffer_cache.clear()
+        buffer = torch.empty(shape, device=device, dtype=dtype)
+        _buffer_cache[key] = buffer
+    return buffer
+
+
+def get_zeroed_buffer(name: str, shape: Tuple[int, ...], device: torch.device, dtype: torch.dtype) -> torch.Tensor:
+    """Same as get_buffer(), but the buffer is zeroed."""
+    return get_buffer(name, shape, device, dtype).zero_()
+
+
+def get_regularizor_buffers(
+    bs: int, n: int, hw: int, device: torch.device, dtype: torch.dtype
+) -> Tuple[torch.Tensor, ...]:
+    """Get reusable output buffers for get_regularizor_hessians(), i.e. (B, N, HW) for F, K and (B, N) for D, G, L, vs, vo."""
+    F, K = get_buffer("F", (bs, n, hw), device, dtype), get_buffer("K", (bs, n, hw), device, dtype)
+    D, G, L = [get_buffer(name, (bs, n), device, dtype) for name in ("D", "G", "L")]
+    vs, vo = get_buffer("vs", (bs, n), device, dtype), get_buffer("vo", (bs, n), device, dtype)
+    return F, K, D, G, L, vs, vo
+
+
 def safe_scatter_add_mat(A: torch.Tensor, ii, jj, n: int, m: int) -> torch.Tensor:
     """Turn a dense (B, N, D, D) matrix into a sparse (B, n*m, D, D) matrix by
     scattering with the indices ii and jj.
@@ -88,8 +190,12 @@ def safe_scatter_add_mat(A: torch.Tensor, ii, jj, n: int, m: int) -> torch.Tenso
         where each indices ij is the dependency between camera i and camera j.
     """
     # Filter out any negative and out of bounds indices
+    # NOTE we zero out invalid entries instead of indexing with the mask, this avoids a host sync and a gather
     v = (ii >= 0) & (jj >= 0) & (ii < n) & (jj < m)
-    return scatter_sum(A[:, v], ii[v] * m + jj[v], dim=1, dim_size=n * m)
+    idx = torch.where(v, ii.long() * m + jj.long(), 0)
+    v = v.view((1, -1) + (1,) * (A.ndim - 2))
+    out = A.new_zeros((A.shape[0], n * m) + A.shape[2:])
+    return out.scatter_add_(1, idx.view(v.shape).expand_as(A), A.masked_fill(~v, 0))
 
 
 def safe_scatter_add_vec(b, ii, n):
@@ -98,17 +204,31 @@ def safe_scatter_add_vec(b, ii, n):
     """
     # Filter out any negative and out of bounds indices
     v = (ii >= 0) & (ii < n)
-    return scatter_sum(b[:, v], ii[v], dim=1, dim_size=n)
+    idx = torch.where(v, ii.long(), 0)
+    v = v.view((1, -1) + (1,) * (b.ndim - 2))
+    out = b.new_zeros((b.shape[0], n) + b.shape[2:])
+    return out.scatter_add_(1, idx.view(v.shape).expand_as(b), b.masked_fill(~v, 0))
+
+
+def get_hessian_scatter_indices(ii: torch.Tensor, jj: torch.Tensor, m: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Get the flat indices and validity mask for scattering the concatenated edge blocks [Hii, Hij, Hji, Hjj]
+    into a (M x M) block Hessian with a single scatter. Negative indices belong to fixed poses and are filtered out.
+
+    These only depend on the factor graph, so we can compute them once and reuse them across iterations.
+    """
+    rows, cols = torch.cat([ii, ii, jj, jj]), torch.cat([ii, jj, ii, jj])
+    v = (rows >= 0) & (cols >= 0)
+    return rows[v] * m + cols[v], v
 
 
-def safe_scatter_add_mat_inplace(H, data, ii, jj, B, M, D):
-    v = (ii >= 0) & (jj >= 0)
-    H.scatter_add_(1, (ii[v] * M + jj[v]).view(1, -1, 1, 1).repeat(B, 1, D, D), data[:, v])
+# NOTE scatter_add_ accepts strided index tensors, so we expand the indices as a view instead of materializing copies
+def safe_scatter_add_mat_inplace(H, data, idx, v, B, D):
+    H.scatter_add_(1, idx.view(1, -1, 1, 1).expand(B, -1, D, D), data[:, v])
 
 
 def safe_scatter_add_vec_inplace(b, data, ii, B, M, D):
     v = ii >= 0
-    b.scatter_add_(1, ii[v].view(1, -1, 1).repeat(B, 1, D), data[:, v])
+    b.scatter_add_(1, ii[v].view(1, -1, 1).expand(B, -1, D), data[:, v])
 
 
 def additive_retr(disps: torch.Tensor, dz: torch.Tensor, ii) -> torch.Tensor:
@@ -119,7 +239,15 @@ def additive_retr(disps: torch.Tensor, dz: torch.Tensor, ii) -> torch.Tensor:
     d_k2 = d_k1 + dz
     """
     ii = ii.to(device=dz.device)
-    return disps + scatter_sum(dz, ii, dim=1, dim_size=disps.shape[1])
+    return disps.index_add(1, ii, dz)
+
+
+def additive_retr_(disps: torch.Tensor, dz: torch.Tensor, ii) -> torch.Tensor:
+    """In-place version of additive_retr(). When disps is a view of the global buffer, e.g. all_disps[:, :t1],
+    this updates the global buffer directly without an extra allocation and copy.
+    """
+    ii = ii.to(device=dz.device)
+    return disps.index_add_(1, ii, dz)
 
 
 def pose_retr(poses: SE3, dx: torch.Tensor, ii) -> SE3:
@@ -130,12 +258,14 @@ def pose_retr(poses: SE3, dx: torch.Tensor, ii) -> SE3:
     g_k2 = exp^(dx) * g_k1
     """
     ii = ii.to(device=dx.device)
-    return poses.retr(scatter_sum(dx, ii, dim=1, dim_size=poses.shape[1]))
+    dx_sum = dx.new_zeros((dx.shape[0], poses.shape[1]) + dx.shape[2:])
+    return poses.retr(dx_sum.index_add_(1, ii, dx))
 
 
 def is_positive_definite(matrix: torch.Tensor, eps=2e-5) -> bool:
-    """Check if a Matrix is positive definite by checking symmetry looking at the eigenvalues"""
-    return bool((abs(matrix - matrix.mT) < eps).all() and (torch.linalg.eigvals(matrix).real >= 0).all())
+    """Check if a Matrix is positive definite by checking symmetry and attempting a Cholesky decomposition"""
+    _, info = torch.linalg.cholesky_ex(matrix)
+    return bool((abs(matrix - matrix.mT) < eps).all() and (info == 0).all())
 
 
 def get_keyframe_window(
@@ -157,6 +287,24 @@ def get_keyframe_window(
     return to_return
 
 
+def get_window_nodes(ii: torch.Tensor, t0: int, t1: int) -> Tuple[torch.Tensor, ...]:
+    """Get the unique nodes kx of the factor graph with their inverse indices kk, as well as the nodes kx_exp
+    expanded with all nodes in [t0, t1] even if they dont contribute. non_empty_nodes marks which of the expanded nodes
+    are actually part of the graph and ne_idx holds their indices, so we can gather / scatter without boolean masks.
+
+    These only depend on the factor graph, so we can compute them once and reuse them across iterations.
+    """
+    kx, kk = torch.unique(ii, return_inverse=True)
+    ts = torch.arange(t0, t1, device=ii.device, dtype=ii.dtype)
+    kx_exp, kk_exp = torch.unique(torch.cat([ts, ii], dim=0), return_inverse=True)
+    # An expanded node is non-empty if any edge ii points to it, we can read this directly from the inverse indices
+    non_empty_nodes = torch.zeros(len(kx_exp), dtype=torch.bool, device=ii.device)
+    non_empty_nodes[kk_exp[len(ts) :]] = True
+    # kx is a sorted subset of kx_exp, i.e. we can get the positions without a synchronizing nonzero()
+    ne_idx = torch.searchsorted(kx_exp, kx)
+    return kx, kk, kx_exp, non_empty_nodes, ne_idx
+
+
 def bundle_adjustment(
     target: torch.Tensor,
     weight: torch.Tensor,
@@ -179,8 +327,14 @@ def bundle_adjustment(
     scale_prior: bool = False,
     alpha: float = 0.01,
     use_double: bool = True,
+    compute_dtype: torch.dtype = torch.float32,
 ) -> None:
-    """Wrapper function around different bundle adjustment methods."""
+    """Wrapper function around different bundle adjustment methods.
+
+    compute_dtype can be set to torch.bfloat16 to assemble the normal equations on tensor cores.
+    This trades accuracy for speed, since the Hessian blocks and the rhs are stored in bfloat16 precision
+    (~3 significant digits). It is only used on GPUs which support it.
+    """
 
     assert sum([structure_only, motion_only]) <= 1, "You can either optimize only motion or structure or both!"
 
@@ -195,30 +349,51 @@ def bundle_adjustment(
     if scale_prior:
         assert disps_sens is not None, "You need to provide prior disparities to optimize with scales!"
         scales, shifts = scales.reshape((1,) + scales.shape), shifts.reshape((1,) + shifts.shape)
+    if compute_dtype == torch.bfloat16 and not supports_bf16_tensor_cores(target.device):
+        print(colored("Warning. bfloat16 is not supported on this device, assembling BA system in float32!", "red"))
+        compute_dtype = torch.float32
+
+    # Bring target and weight into the layout of the residuals once instead of every iteration
+    target = rearrange(target, "b n xy h w -> b n h w xy").contiguous()
+    weight = rearrange(weight, "b n xy h w -> b n h w xy").contiguous()
+
+    # The factor graph does not change over iterations, so we move it to the device and index the window only once
+    ii, jj = ii.to(device=disps.device, dtype=torch.long), jj.to(device=disps.device, dtype=torch.long)
+    fixedp = max(t0, 1)
+    local_edges = (ii - fixedp, jj - fixedp)
+    hessian_indices = get_hessian_scatter_indices(*local_edges, t1 - fixedp)
 
     # Prepare arguments for bundle adjustment
     args = (target, weight, Gs, disps, intrinsics, ii, jj, t0, t1)
     if motion_only:
         ba_function = MoBA
-        skwargs = {}
+        skwargs = {"hessian_indices": hessian_indices, "local_edges": local_edges}
     else:
-        skwargs = {"all_disps_sens": disps_sens, "eta": damping}
+        # The graph does not change over iterations, so we only need to sort the nodes once
+        window_nodes = get_window_nodes(ii, t0, t1)
+        skwargs = {"all_disps_sens": disps_sens, "eta": damping, "window_nodes": window_nodes}
         if scale_prior:
             skwargs["all_scales"], skwargs["all_shifts"] = scales, shifts
             skwargs["alpha"] = alpha
+            # The prior does not change over iterations, so we only gather it for the expanded window nodes once
+            skwargs["disps_sens_exp"] = disps_sens[:, window_nodes[2]].flatten(start_dim=2)
             if structure_only:
                 ba_function = BA_prior_no_motion
             else:
+                skwargs["hessian_indices"], skwargs["local_edges"] = hessian_indices, local_edges
                 ba_function = BA_prior
         else:
             skwargs["structure_only"] = structure_only
+            skwargs["hessian_indices"], skwargs["local_edges"] = hessian_indices, local_edges
             ba_function = BA
 
     #### Bundle Adjustment Loop
-    disps.clamp_(min=1e-3)
+    # NOTE clamp in-place on the shared buffer, but only in the window [0, t1] which is actually read and updated
+    disps_window = disps[:, :t1]
+    disps_window.clamp_(min=1e-3)
     for i in range(iters):
-        ba_function(*args, **skwargs, ep=ep, lm=lm, use_double=use_double)
-        disps.clamp_(min=1e-3)  # Disparities should never be negative
+        ba_function(*args, **skwargs, ep=ep, lm=lm, use_double=use_double, compute_dtype=compute_dtype)
+        disps_window.clamp_(min=1e-3)  # Disparities should never be negative
 
     #### Update data structure
     # Remove the batch dimension again
@@ -229,6 +404,7 @@ def bundle_adjustment(
         scales, shifts = scales[0], shifts[0]
 
 
+@compile_with_fallback
 def get_hessian_and_rhs(
     Jz: torch.Tensor,
     Ji: torch.Tensor,
@@ -239,60 +415,87 @@ def get_hessian_and_rhs(
     valid: torch.Tensor,
     with_structure: bool = True,
     use_double: bool = False,
+    compute_dtype: torch.dtype = torch.float32,
 ):
-    """Get mixed terms of Jacobian and Hessian for constructing the linear system"""
+    """Get mixed terms of Jacobian and Hessian for constructing the linear system
+
+    NOTE target and weight are expected in the layout of the residuals (B, N, H, W, XY)
+    NOTE Jacobians, residuals and weights stay in float32, only the accumulated blocks are cast to float64.
+    Single precision is enough for assembling the normal equations, the numerically critical part is the solver.
+    The batched products can also run in compute_dtype=torch.bfloat16. cuBLAS accumulates internally in float32,
+    but returns bfloat16, so the Hessian blocks and the rhs are rounded to bfloat16 before we cast them up again!
+    """
     if use_double:
         dtype = torch.float64
     else:
         dtype = torch.float32
 
-    B, N, _, ht, wd = target.shape
+    B, N, ht, wd, _ = target.shape
+    D = Ji.shape[-1]
     # Reshape to residuals vector
-    r = rearrange(target, "b n xy h w -> b n h w xy") - coords
-    # Filter out super large residuals
-    low_resid = (r.norm(dim=-1) < 250.0).to(dtype)
-    valid *= low_resid.reshape(low_resid.shape + (1,))  # Unsqueeze without copy by using reshape
-
-    r = rearrange(r.to(dtype), "b n h w xy -> b n (h w xy)")
-    w = 0.001 * (valid * rearrange(weight, "b n xy h w -> b n h w xy"))
-    w = rearrange(w.to(dtype), "b n h w xy -> b n (h w xy) 1")
-
-    Ji = rearrange(Ji, "b n h w xy D -> b n (h w xy) D")
-    Jj = rearrange(Jj, "b n h w xy D -> b n (h w xy) D")
-    wJiT, wJjT = (w * Ji).mT, (w * Jj).mT
-
-    # Each block is B x N x D x D
-    Hii = einsum(wJiT, Ji, "b n i j , b n j k -> b n i k").to(dtype)
-    Hij = einsum(wJiT, Jj, "b n i j , b n j k -> b n i k").to(dtype)
-    Hji = einsum(wJjT, Ji, "b n i j , b n j k -> b n i k").to(dtype)
-    Hjj = einsum(wJjT, Jj, "b n i j , b n j k -> b n i k").to(dtype)
-    # Each rhs term is B x N x D x 1
-    vi = einsum(-wJiT, r, "b n D hwxy, b n hwxy -> b n D").to(dtype)
-    vj = einsum(-wJjT, r, "b n D hwxy, b n hwxy -> b n D").to(dtype)
+    r = target - coords
+    # Filter out super large residuals, compare the squared norm to avoid the sqrt
+    low_resid = (r * r).sum(dim=-1, keepdim=True) < 250.0**2
+    valid.mul_(low_resid)
+
+    # Flatten edges into a single batch dimension, so each product is one batched GEMM
+    r = r.reshape(B * N, ht * wd * 2, 1)
+    w = 0.001 * (valid * weight)
+    w = w.reshape(B * N, ht * wd * 2, 1)
+
+    # Stack [Ji | Jj], so that J^T W J yields all four pose blocks at once
+    J = torch.cat([Ji.reshape(B * N, ht * wd * 2, D), Jj.reshape(B * N, ht * wd * 2, D)], dim=-1)
+    wJ = w * J
+    wJ, J = wJ.to(compute_dtype), J.to(compute_dtype)
+
+    # (BN x 2D x HWXY) x (BN x HWXY x 2D) -> (BN x 2D x 2D), each block is B x N x D x D
+    H = torch.bmm(wJ.mT, J).to(dtype).view(B, N, 2 * D, 2 * D)
+    Hii, Hij = H[..., :D, :D], H[..., :D, D:]
+    Hji, Hjj = H[..., D:, :D], H[..., D:, D:]
+    # Each rhs term is B x N x D
+    v = -torch.bmm(wJ.mT, r.to(compute_dtype)).to(dtype).view(B, N, 2 * D)
+    vi, vj = v[..., :D], v[..., D:]
 
     if not with_structure:
         return Hii, Hij, Hji, Hjj, vi, vj
 
     # Mixed term of camera and disp blocks
-    # (BNHW x D x 2) x (BNHW x 2 x 1) -> (BNHW x D x 1)
-    Jz = rearrange(Jz, "b n h w xy 1 -> b n (h w) xy 1")
-    wJiT = rearrange(wJiT, "b n D (hw xy) -> b n hw D xy", hw=ht * wd, xy=2)
-    wJjT = rearrange(wJjT, "b n D (hw xy) -> b n hw D xy", hw=ht * wd, xy=2)
-    Eik = torch.matmul(wJiT, Jz).squeeze(-1).to(dtype)
-    Ejk = torch.matmul(wJjT, Jz).squeeze(-1).to(dtype)
+    # (BNHW x 2D x 2) x (BNHW x 2 x 1) -> (BNHW x 2D x 1)
+    Jz = Jz.reshape(B * N * ht * wd, 2, 1)
+    E = torch.bmm(wJ.view(B * N * ht * wd, 2, 2 * D).mT, Jz.to(compute_dtype)).to(dtype).view(B, N, ht * wd, 2 * D)
+    Eik, Ejk = E[..., :D], E[..., D:]
 
     # Sparse diagonal block of disparities only
-    w = rearrange(w, "b n (hw xy) 1 -> b n hw xy", hw=ht * wd)
-    r = rearrange(r, "b n (hw xy) -> b n hw xy", hw=ht * wd)
-    wJzT = (w[..., None] * Jz).mT  # (B N HW 1 XY)
-    wk = einsum(-wJzT.squeeze(-2), r, "b n hw xy, b n hw xy -> b n hw").to(dtype)
-    Ck = einsum(wJzT.squeeze(-2), Jz.squeeze(-1), "b n hw xy, b n hw xy -> b n hw").to(dtype)
+    w = w.view(B, N, ht * wd, 2)
+    r = r.view(B, N, ht * wd, 2)
+    wJz = w * Jz.view(B, N, ht * wd, 2)
+    wk = -(wJz * r).sum(dim=-1).to(dtype)
+    Ck = (wJz * Jz.view(B, N, ht * wd, 2)).sum(dim=-1).to(dtype)
 
     return Hii, Hij, Hji, Hjj, Eik, Ejk, Ck, vi, vj, wk
 
 
+@compile_with_fallback
 def scatter_pose_structure(
-    Hii, Hij, Hji, Hjj, Eik, Ejk, Ck, vi, vj, wk, ii, jj, kk, bs, m, n, d, use_double: bool = False
+    Hii,
+    Hij,
+    Hji,
+    Hjj,
+    Eik,
+    Ejk,
+    Ck,
+    vi,
+    vj,
+    wk,
+    ii,
+    jj,
+    kk,
+    bs,
+    m,
+    n,
+    d,
+    use_double: bool = False,
+    hessian_indices: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
 ):
     """Scatter the pose and structure hessians.
     This creates a sparse system out of dense blocks.
@@ -303,19 +506,18 @@ def scatter_pose_structure(
         dtype = torch.float32
 
     # Scatter add all edges and assemble full Hessian
-    # 4 x (B, N, 6, 6) -> (B, M x M, 6, 6)
+    # (B, 4 x N, 6, 6) -> (B, M x M, 6, 6)
+    if hessian_indices is None:
+        hessian_indices = get_hessian_scatter_indices(ii, jj, m)
     H = torch.zeros(bs, m * m, d, d, device=Hii.device, dtype=dtype)
-    safe_scatter_add_mat_inplace(H, Hii, ii, ii, bs, m, d)
-    safe_scatter_add_mat_inplace(H, Hij, ii, jj, bs, m, d)
-    safe_scatter_add_mat_inplace(H, Hji, jj, ii, bs, m, d)
-    safe_scatter_add_mat_inplace(H, Hjj, jj, jj, bs, m, d)
+    safe_scatter_add_mat_inplace(H, torch.cat([Hii, Hij, Hji, Hjj], dim=1), *hessian_indices, bs, d)
     H = H.reshape(bs, m, m, d, d)
 
-    v = safe_scatter_add_vec(vi, ii, m) + safe_scatter_add_vec(vj, jj, m)
-    v = rearrange(v, "b m d -> b m 1 d 1")
+    v = safe_scatter_add_vec(torch.cat([vi, vj], dim=1), torch.cat([ii, jj]), m)
+    v = v.view(bs, m, 1, d, 1)
 
     E = safe_scatter_add_mat(Eik, ii, kk, m, n) + safe_scatter_add_mat(Ejk, jj, kk, m, n)
-    E = rearrange(E, "b (m n) hw d -> b m (n hw) d 1", m=m, n=n)
+    E = E.view(bs, m, -1, d, 1)  # (B, M x N, HW, D) -> (B, M, N x HW, D, 1)
 
     # Depth only appears if k = i, therefore the gradient is 0 for k != i
     # This reduces the number of elements to M defined by kk
@@ -325,6 +527,39 @@ def scatter_pose_structure(
     return H, E, C, v, w
 
 
+@compile_with_fallback
+def add_structure_prior(
+    C: torch.Tensor, w: torch.Tensor, eta: torch.Tensor, disps: torch.Tensor, disps_sens: torch.Tensor, alpha: float
+):
+    """Add the prior term || d - d_prior ||^2 and damping to the structure block C and its rhs w.
+    This is a purely pointwise chain over (B, N, HW), which we compile into a single fused kernel.
+    """
+    has_sens = (disps_sens > 0).to(C.dtype)
+    # Add alpha only for where there is a prior, else only add normal damping (from original DROID-SLAM implementation)
+    C = C + alpha * has_sens + (1 - has_sens) * eta + 1e-7
+    w = w - has_sens * alpha * (disps - disps_sens)
+    return C, w
+
+
+@compile_with_fallback
+def get_scaled_prior_residuals(
+    disps: torch.Tensor,
+    disps_sens: torch.Tensor,
+    scales: torch.Tensor,
+    shifts: torch.Tensor,
+    conf: torch.Tensor,
+    alpha: float,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Get the residuals r2 = d - (s * d_prior + o) of the scale ambiguous prior for (B, N, HW) disparities
+    and their weighted contribution alpha * conf * r2 to the rhs. This is a purely pointwise chain,
+    which we compile into a single fused kernel instead of materializing the scaled prior.
+    """
+    # Prior should never be negative, i.e. clip this if s and o are diverging
+    scaled_prior = torch.addcmul(shifts[..., None], disps_sens, scales[..., None]).clamp(min=1e-3)
+    r2 = disps - scaled_prior
+    return r2, alpha * conf * r2
+
+
 def MoBA(
     target: torch.Tensor,
     weight: torch.Tensor,
@@ -339,9 +574,13 @@ def MoBA(
     lm: float = 1e-4,
     rig: int = 1,
     use_double: bool = False,
+    compute_dtype: torch.dtype = torch.float32,
+    hessian_indices: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+    local_edges: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
 ) -> None:
     """Motion only bundle adjustment for optimizing pose nodes inside a window [t0, t1].
-    The factor graph is defined by ii, jj.
+    The factor graph is defined by ii, jj. Pass hessian_indices and local_edges (ii, jj shifted into the window
+    as int64) to reuse them for the same graph.
 
     NOTE This always builds the system for poses 0:t1, but then excludes all poses as fixed before t0.
     """
@@ -364,54 +603,57 @@ def MoBA(
         poses, disps, intrinsics, ii, jj, jacobian=True, use_double=use_double
     )
     # NOTE normally this should be -Ji / -Jj and then vi / vj = -J^T @ r
-    Ji, Jj, Jz = -Ji.to(dtype), -Jj.to(dtype), -Jz.to(dtype)
+    Ji, Jj, Jz = -Ji, -Jj, -Jz  # Accumulate in float32, the blocks are cast to dtype afterwards
 
     ### 2: Construct linear system
     Hii, Hij, Hji, Hjj, vi, vj = get_hessian_and_rhs(
-        Jz, Ji, Jj, target, weight, coords, valid, with_structure=False, use_double=use_double
+        Jz,
+        Ji,
+        Jj,
+        target,
+        weight,
+        coords,
+        valid,
+        with_structure=False,
+        use_double=use_double,
+        compute_dtype=compute_dtype,
     )
 
     # only optimize keyframe poses
     m = m - fixedp
-    ii = ii / rig - fixedp
-    jj = jj / rig - fixedp
-    ii, jj = ii.to(torch.int64), jj.to(torch.int64)
+    if local_edges is None:
+        local_edges = ((ii // rig - fixedp).long(), (jj // rig - fixedp).long())
+    ii, jj = local_edges
 
     # Assemble larger sparse system for optimization window
+    if hessian_indices is None:
+        hessian_indices = get_hessian_scatter_indices(ii, jj, m)
     H = torch.zeros(bs, m * m, d, d, device=target.device, dtype=dtype)
-    safe_scatter_add_mat_inplace(H, Hii, ii, ii, bs, m, d)
-    safe_scatter_add_mat_inplace(H, Hij, ii, jj, bs, m, d)
-    safe_scatter_add_mat_inplace(H, Hji, jj, ii, bs, m, d)
-    safe_scatter_add_mat_inplace(H, Hjj, jj, jj, bs, m, d)
+    safe_scatter_add_mat_inplace(H, torch.cat([Hii, Hij, Hji, Hjj], dim=1), *hessian_indices, bs, d)
     H = H.reshape(bs, m, m, d, d)
 
     v = torch.zeros(bs, m, d, device=target.device, dtype=dtype)
-    safe_scatter_add_vec_inplace(v, vi, ii, bs, m, d)
-    safe_scatter_add_vec_inplace(v, vj, jj, bs, m, d)
+    safe_scatter_add_vec_inplace(v, torch.cat([vi, vj], dim=1), torch.cat([ii, jj]), bs, m, d)
 
     H = rearrange(H, "b n1 n2 d1 d2 -> b (n1 d1) (n2 d2)")
-    H = H + (ep + lm * H) * torch.eye(H.shape[1], device=H.device, dtype=dtype)  # Damping
+    # Damping, only touch the diagonal in-place instead of multiplying with a full identity
+    H.diagonal(dim1=-2, dim2=-1).mul_(1 + lm).add_(ep)
     v = rearrange(v, "b n d -> b (n d) 1")
 
     ### 3: solve the system + apply retraction ###
-    solver = CholeskySolver
-    dx = solver.apply(H, v)
-    if torch.isnan(dx).any():
+    # NOTE the solvers dont raise or return NaN when the decomposition fails, they mark it in the success mask
+    dx, success = CholeskySolver.apply(H, v)
+    if not bool(success.all()):
         print("Cholesky decomposition failed, trying LU decomposition")
-        solver = LUSolver
-        dx = solver.apply(H, v)
-        if torch.isnan(dx).any():
+        dx, success = LUSolver.apply(H, v)
+        if not bool(success.all()):
             print("LU decomposition failed, using 0 update ...")
             dx = torch.zeros_like(dx)
 
     dx = rearrange(dx, "b (n1 d1) 1 -> b n1 d1", n1=m, d1=d).float()  # Always convert to system precision at float32
 
-    # Update only un-fixed poses
-    poses1, poses2 = poses[:, :fixedp], poses[:, fixedp:]
-    poses2 = poses2.retr(dx)
-    poses = lietorch.cat([poses1, poses2], dim=1)
-    # Update global poses
-    all_poses[:, :t1] = poses
+    # Update only un-fixed global poses in-place
+    all_poses[:, fixedp:t1] = all_poses[:, fixedp:t1].retr(dx)
 
 
 def BA(
@@ -432,6 +674,10 @@ def BA(
     structure_only: bool = False,
     rig: int = 1,
     use_double: bool = False,
+    compute_dtype: torch.dtype = torch.float32,
+    window_nodes: Optional[Tuple[torch.Tensor, ...]] = None,
+    hessian_indices: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+    local_edges: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
 ) -> None:
     """Bundle Adjustment for optimizing both poses and disparities.
 
@@ -451,6 +697,9 @@ def BA(
         ii: Timesteps of outgoing edges of shape (|E|)
         jj: Timesteps of incoming edges of shape (|E|)
         t0, t1: Optimization window
+        window_nodes: Unique nodes of the graph, see get_window_nodes(). Pass these to reuse them for the same graph
+        hessian_indices: Scatter pattern of the pose blocks, see get_hessian_scatter_indices()
+        local_edges: ii, jj shifted into the optimization window as int64
     """
     if use_double:
         dtype = torch.float64
@@ -475,63 +724,80 @@ def BA(
     coords, valid, (Ji, Jj, Jz) = projective_transform(
         poses, disps, intrinsics, ii, jj, jacobian=True, use_double=use_double
     )
-    Jz, Ji, Jj = -Jz.to(dtype), -Ji.to(dtype), -Jj.to(dtype)
+    Jz, Ji, Jj = -Jz, -Ji, -Jj  # Accumulate in float32, the blocks are cast to dtype afterwards
 
     ### 2: Assemble linear system ###
     Hii, Hij, Hji, Hjj, Eik, Ejk, Ck, vi, vj, wk = get_hessian_and_rhs(
-        Jz, Ji, Jj, target, weight, coords, valid, use_double
+        Jz, Ji, Jj, target, weight, coords, valid, use_double=use_double, compute_dtype=compute_dtype
     )
 
     # Construct larger sparse system
-    kx, kk = torch.unique(ii, return_inverse=True)
-    ts = torch.arange(t0, t1).long().to(ii.device)
-    kx_exp, kk_exp = torch.unique(torch.cat([ts, ii], dim=0), return_inverse=True)
+    if window_nodes is None:
+        window_nodes = get_window_nodes(ii, t0, t1)
+    kx, kk, kx_exp, non_empty_nodes, ne_idx = window_nodes  # We can use ne_idx to filter eta
 
     n = len(kx)  # Actual unique key frame nodes to be updated
     n_exp = len(kx_exp)  # Expand with [t0, t1] to include all nodes in interval even if they dont contribute
     empty_nodes = n_exp - n
-    non_empty_nodes = torch.isin(kx_exp, kx)  # We can use this to filter eta
     # only optimize keyframe poses
     m = m - fixedp
-    ii = ii // rig - fixedp
-    jj = jj // rig - fixedp
+    if local_edges is None:
+        local_edges = ((ii // rig - fixedp).long(), (jj // rig - fixedp).long())
+    ii, jj = local_edges
 
     H, E, C, v, w = scatter_pose_structure(
-        Hii, Hij, Hji, Hjj, Eik, Ejk, Ck, vi, vj, wk, ii, jj, kk, bs, m, n, d, use_double=use_double
+        Hii,
+        Hij,
+        Hji,
+        Hjj,
+        Eik,
+        Ejk,
+        Ck,
+        vi,
+        vj,
+        wk,
+        ii,
+        jj,
+        kk,
+        bs,
+        m,
+        n,
+        d,
+        use_double=use_double,
+        hessian_indices=hessian_indices,
     )
-    eta = rearrange(eta, "n h w -> 1 n (h w)")
+    eta = eta.view(1, -1, ht * wd)
 
     if disps_sens is not None:
-        has_sens = disps_sens[:, kx].view(bs, -1, ht * wd) > 0
-        has_sens = has_sens.int()
-        # Add alpha only for where there is a prior, else only add normal damping (from original DROID-SLAM implementation)
-        C = C + alpha * has_sens + (1 - has_sens) * eta[:, non_empty_nodes] + 1e-7
-        w = w - has_sens * alpha * (disps[:, kx] - disps_sens[:, kx]).view(bs, -1, ht * wd)
+        C, w = add_structure_prior(
+            C,
+            w,
+            eta.index_select(1, ne_idx),
+            disps[:, kx].view(bs, -1, ht * wd),
+            disps_sens[:, kx].view(bs, -1, ht * wd),
+            alpha,
+        )
     else:
-        C = C + eta[:, non_empty_nodes] + 1e-7  # Apply damping
-    C = rearrange(C, "b n hw -> b (n hw) 1 1")
-    w = rearrange(w, "b n hw -> b (n hw) 1 1")
+        C = C + eta.index_select(1, ne_idx) + 1e-7  # Apply damping
+    C = C.view(bs, -1, 1, 1)
+    w = w.view(bs, -1, 1, 1)
 
     ### 3: solve the system ###
     if structure_only:
         dz = schur_block_solve(H, E, C, v, w, ep=ep, lm=lm, structure_only=True, use_double=use_double)
-        dz = dz.float  # Finally always convert to system precision in float32
-        dz = rearrange(dz, "b (n h w) 1 1 -> b n h w", n=n, h=ht, w=wd)
+        dz = dz.float()  # Finally always convert to system precision in float32
+        dz = dz.view(bs, n, ht, wd)
         ### 4: apply retraction ###
-        all_disps[:, :t1] = additive_retr(disps, dz, kx)
+        additive_retr_(disps, dz, kx)
 
     else:
         dx, dz = schur_block_solve(H, E, C, v, w, ep=ep, lm=lm, use_double=use_double)
         dx, dz = dx.float(), dz.float()  # Finally always convert to system precision in float32
-        dz = rearrange(dz, "b (n h w) 1 1 -> b n h w", n=n, h=ht, w=wd)
+        dz = dz.view(bs, n, ht, wd)
         ### 4: apply retraction ###
-        # Update only un-fixed poses
-        poses1, poses2 = poses[:, :fixedp], poses[:, fixedp:]
-        poses2 = poses2.retr(dx)
-        poses = lietorch.cat([poses1, poses2], dim=1)
-        # Update global poses and disparities
-        all_poses[:, :t1] = poses
-        all_disps[:, :t1] = additive_retr(disps, dz, kx)
+        # Update only un-fixed global poses in-place and disparities
+        all_poses[:, fixedp:t1] = all_poses[:, fixedp:t1].retr(dx)
+        additive_retr_(disps, dz, kx)
 
 
 def get_augmented_hessian_and_rhs_full(H, E, C, D, G, F, L, K, v, w, vs, vo, use_double: bool = False):
@@ -550,73 +816,81 @@ def get_augmented_hessian_and_rhs_full(H, E, C, D, G, F, L, K, v, w, vs, vo, use
     E_aug consists of E, F, K;
     and the Schur trick is still used on C,
     since we can easily invert it and it is by far the largest.
+
+    D, G, L, vs, vo are expected in the structured form (B, N) and F, K as (B, N, HW), see get_regularizor_hessians().
+    Since these blocks are (block) diagonal, we write their entries directly into the diagonals of the augmented system.
     """
     bs, m, m, d, d = H.shape
-    bs, n, n = D.shape
+    bs, n, hw = F.shape
     if use_double:
         dtype = torch.float64
     else:
         dtype = torch.float32
 
-    # There is no coupling between pose graph and scale, shift parameters -> We have to zero pad the augmented hessian
-    zeros_pose_so = torch.zeros((bs, d * m, 2 * n), device=H.device, dtype=dtype)
-
-    H = rearrange(H, "b m1 m2 d1 d2 -> b (m1 d1) (m2 d2)")
-    H_top = torch.cat([H, zeros_pose_so], dim=2)
-
-    DL = torch.cat([D, L], dim=2)
-    LG = torch.cat([L.mT, G], dim=2)  # Since L is diagonal, L^T = L
-    DLG = torch.cat([DL, LG], dim=1)
-    H_bot = torch.cat([zeros_pose_so.mT, DLG], dim=2)
-    H_aug = torch.cat([H_top, H_bot], dim=1)
-
-    E = rearrange(E, "b m (n hw) d 1 -> b (d m) (n hw)", m=m, n=n)
-    E_aug = torch.cat([E, F, K], dim=1)
-
-    v = rearrange(v, "b m 1 d 1 -> b (m d) 1")
-    v_aug = torch.cat([v, vs, vo], dim=1)
+    dm = d * m
+    # Allocate the augmented system once and copy the blocks into views instead of concatenating
+    H_aug = torch.empty((bs, dm + 2 * n, dm + 2 * n), device=H.device, dtype=dtype)
+    # There is no coupling between pose graph and scale, shift parameters -> We have to zero these blocks
+    # The scale and shift blocks themselves are only non-zero on their diagonals
+    H_aug[:, :dm, dm:].zero_()
+    H_aug[:, dm:, :dm].zero_()
+    H_aug[:, dm:, dm:].zero_()
+    # (B, M, M, D, D) -> (B, (M D), (M D))
+    H_aug[:, :dm, :dm].unflatten(1, (m, d)).unflatten(-1, (m, d)).copy_(H.permute(0, 1, 3, 2, 4))
+    H_aug[:, dm : dm + n, dm : dm + n].diagonal(dim1=1, dim2=2).copy_(D)
+    H_aug[:, dm : dm + n, dm + n :].diagonal(dim1=1, dim2=2).copy_(L)
+    H_aug[:, dm + n :, dm : dm + n].diagonal(dim1=1, dim2=2).copy_(L)  # Since L is diagonal, L^T = L
+    H_aug[:, dm + n :, dm + n :].diagonal(dim1=1, dim2=2).copy_(G)
+
+    E_aug = torch.empty((bs, dm + 2 * n, E.shape[2]), device=E.device, dtype=dtype)
+    # (B, M, (N HW), D, 1) -> (B, (D M), (N HW))
+    E_aug[:, :dm].unflatten(1, (d, m)).copy_(E.squeeze(-1).permute(0, 3, 1, 2))
+    # Each frame only couples with its own pixels, i.e. (B, N, (N HW)) is block diagonal with the (B, N, HW) entries
+    E_aug[:, dm:].zero_()
+    E_aug[:, dm : dm + n].unflatten(-1, (n, hw)).diagonal(dim1=1, dim2=2).copy_(F.mT)
+    E_aug[:, dm + n :].unflatten(-1, (n, hw)).diagonal(dim1=1, dim2=2).copy_(K.mT)
+
+    v_aug = torch.empty((bs, dm + 2 * n, 1), device=v.device, dtype=dtype)
+    v_aug[:, :dm].copy_(v.view(bs, dm, 1))
+    v_aug[:, dm : dm + n, 0].copy_(vs)
+    v_aug[:, dm + n :, 0].copy_(vo)
 
     return H_aug, E_aug, C, v_aug, w
 
 
+@compile_with_fallback
 def get_regularizor_jacobians(
-    disps_sens: torch.Tensor, weights: torch.Tensor, bs: int, n: int, ht: int, wd: int, use_double: bool = False
+    disps_sens: torch.Tensor,
+    weights: torch.Tensor,
+    bs: int,
+    n: int,
+    ht: int,
+    wd: int,
+    mask: Optional[torch.Tensor] = None,
 ):
-    """Get Jacobians of second residual || d_i - (s * dprior_i + o) ||^2 w.r.t s and o."""
+    """Get Jacobians of second residual || d_i - (s * dprior_i + o) ||^2 w.r.t s and o.
 
-    def scatter_jacobian(A, ii, jj, n, m):
-        B = safe_scatter_add_mat(A, ii.int(), jj.to(torch.int64), n, m)
-        B = rearrange(B, "b (n1 n2) 1 1 -> b n1 n2", n1=n, n2=m)
-        return B
-
-    if use_double:
-        dtype = torch.float64
+    Each pixel only depends on the scale and shift of its own frame, i.e. the (B x NHW x N) Jacobians are
+    block diagonal with a single non-zero entry per pixel. We only store these entries in shape (B, N, HW).
+    An optional boolean mask of shape (N,) zeroes out the Jacobians of nodes, that do not contribute to the energy.
+    NOTE these stay in the precision of the inputs, get_regularizor_hessians() casts the reduced blocks.
+    """
+    weights = weights.view(bs, n, ht * wd)
+    Js = -disps_sens.view(bs, n, ht * wd)
+    if mask is None:
+        Jo = -torch.ones_like(Js)
+        wJs, wJo = weights * Js, -weights
     else:
-        dtype = torch.float32
-
-    Jsi = -disps_sens.view(bs, n * ht * wd, 1, 1) * torch.ones(
-        bs, n * ht * wd, 1, 1, device=disps_sens.device, dtype=dtype
-    )
-    Joi = -torch.ones(bs, n * ht * wd, 1, 1, device=disps_sens.device, dtype=dtype)
-    wJsi = weights.view(bs, n * ht * wd, 1, 1) * Jsi
-    wJoi = weights.view(bs, n * ht * wd, 1, 1) * Joi
-
-    # Scatter pattern for r2 Jacobians
-    jsii = torch.arange(n, device=disps_sens.device).repeat_interleave(ht * wd)
-    jsjj = torch.arange(0, ht * wd, device=disps_sens.device).repeat(n)
-    jjk = ht * wd * torch.arange(n, device=disps_sens.device).repeat_interleave(ht * wd)
-    jsjj = jsjj + jjk
-
-    # Jacobians: (B x N x NHW) for Js, Jo and (B x NHW x NHW) for Jd
-    Js = scatter_jacobian(Jsi, jsjj, jsii, n * ht * wd, n)
-    wJs = scatter_jacobian(wJsi, jsjj, jsii, n * ht * wd, n)
-    Jo = scatter_jacobian(Joi, jsjj, jsii, n * ht * wd, n)
-    wJo = scatter_jacobian(wJoi, jsjj, jsii, n * ht * wd, n)
-    Js, wJs, Jo, wJo = Js.to(dtype), wJs.to(dtype), Jo.to(dtype), wJo.to(dtype)
+        # Gate the nodes while building the Jacobians instead of a masked write afterwards
+        mask = mask.to(Js.dtype).view(1, n, 1)
+        Js = Js * mask
+        Jo = (-mask).expand(bs, n, ht * wd)
+        wJs, wJo = weights * Js, weights * Jo
 
     return Js, Jo, wJs, wJo
 
 
+@compile_with_fallback
 def get_regularizor_hessians(
     Js: torch.Tensor,
     wJs: torch.Tensor,
@@ -629,23 +903,36 @@ def get_regularizor_hessians(
     ht: int,
     wd: int,
     use_double: bool = False,
+    out: Optional[Tuple[torch.Tensor, ...]] = None,
 ):
     """Get Hessian blocks for the regularizor term
-    res = || d_i - (s * dprior_i + o) ||^2."""
+    res = || d_i - (s * dprior_i + o) ||^2.
+
+    Since the Jacobians are block diagonal per frame, see get_regularizor_jacobians(), the blocks D, G, L
+    are diagonal and only returned as (B, N) vectors. The mixed terms F, K with the disparities are returned
+    per pixel as (B, N, HW) and the rhs vs, vo as (B, N).
+    The blocks can be written into preallocated buffers out = (F, K, D, G, L, vs, vo), see get_regularizor_buffers().
+    """
     if use_double:
         dtype = torch.float64
     else:
         dtype = torch.float32
 
-    F = alpha * wJs.mT.to(dtype)  # torch.matmul(Js.mT, Jd) # Multiplication with diagonal is the same
-    K = alpha * wJo.mT.to(dtype)  # torch.matmul(Jo.mT, Jd) # Multiplication with diagonal is the same
-    D = alpha * torch.matmul(wJs.mT.to(dtype), Js.to(dtype)).to(dtype)
-    G = alpha * torch.matmul(wJo.mT.to(dtype), Jo.to(dtype)).to(dtype)
-    L = alpha * torch.matmul(wJs.mT.to(dtype), Jo.to(dtype)).to(dtype)
-
-    vs = torch.matmul(-alpha * wJs.mT.to(dtype), res.view(bs, n * ht * wd, 1).to(dtype)).to(dtype)
-    vo = torch.matmul(-alpha * wJo.mT.to(dtype), res.view(bs, n * ht * wd, 1).to(dtype)).to(dtype)
-
+    # Reduce in the precision of the Jacobians and only cast the resulting blocks to the system precision
+    res = res.view(bs, n, ht * wd).to(Js.dtype)
+    F = (alpha * wJs).to(dtype)  # Multiplication with diagonal Jd is the same
+    K = (alpha * wJo).to(dtype)  # Multiplication with diagonal Jd is the same
+    D = (alpha * (wJs * Js).sum(dim=-1)).to(dtype)
+    G = (alpha * (wJo * Jo).sum(dim=-1)).to(dtype)
+    L = (alpha * (wJs * Jo).sum(dim=-1)).to(dtype)
+
+    vs = (-alpha * (wJs * res).sum(dim=-1)).to(dtype)
+    vo = (-alpha * (wJo * res).sum(dim=-1)).to(dtype)
+
+    if out is not None:
+        for buffer, block in zip(out, (F, K, D, G, L, vs, vo)):
+            buffer.copy_(block)
+        return out
     return F, K, D, G, L, vs, vo
 
 
@@ -671,6 +958,11 @@ def BA_prior(
     alpha: float = 0.01,
     reweight_prior: bool = False,
     use_double: bool = False,
+    compute_dtype: torch.dtype = torch.float32,
+    hessian_indices: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+    local_edges: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+    window_nodes: Optional[Tuple[torch.Tensor, ...]] = None,
+    disps_sens_exp: Optional[torch.Tensor] = None,
 ):
     """Bundle Adjustment for optimizing with a depth prior.
     Monocular depth can only be estimated up to an unknown global scale.
@@ -697,117 +989,136 @@ def BA_prior(
     coords, valid, (Ji, Jj, Jz) = projective_transform(
         poses, disps, intrinsics, ii, jj, jacobian=True, use_double=use_double
     )
-    Jz, Ji, Jj = -Jz.to(dtype), -Ji.to(dtype), -Jj.to(dtype)
+    Jz, Ji, Jj = -Jz, -Ji, -Jj  # Accumulate in float32, the blocks are cast to dtype afterwards
 
     ### 2: Assemble linear system ###
     Hii, Hij, Hji, Hjj, Eik, Ejk, Ck, vi, vj, wk = get_hessian_and_rhs(
-        Jz, Ji, Jj, target, weight, coords, valid, use_double=use_double
+        Jz, Ji, Jj, target, weight, coords, valid, use_double=use_double, compute_dtype=compute_dtype
     )
 
     # Construct larger sparse system
-    kx, kk = torch.unique(ii, return_inverse=True)
-    ts = torch.arange(t0, t1).long().to(ii.device)
-    kx_exp, kk_exp = torch.unique(torch.cat([ts, ii], dim=0), return_inverse=True)
+    if window_nodes is None:
+        window_nodes = get_window_nodes(ii, t0, t1)
+    kx, kk, kx_exp, non_empty_nodes, ne_idx = window_nodes  # We can use ne_idx to filter eta
 
     n = len(kx)  # Actual unique key frame nodes to be updated
     n_exp = len(kx_exp)  # Expand with [t0, t1] to include all nodes in interval even if they dont contribute
     empty_nodes = n_exp - n
-    non_empty_nodes = torch.isin(kx_exp, kx)  # We can use this to filter eta
     # only optimize keyframe poses
     m = m - fixedp
-    ii = ii - fixedp
-    jj = jj - fixedp
+    if local_edges is None:
+        local_edges = ((ii - fixedp).long(), (jj - fixedp).long())
+    ii, jj = local_edges
 
     H, E, C, v, w = scatter_pose_structure(
-        Hii, Hij, Hji, Hjj, Eik, Ejk, Ck, vi, vj, wk, ii, jj, kk, bs, m, n, d, use_double=use_double
+        Hii,
+        Hij,
+        Hji,
+        Hjj,
+        Eik,
+        Ejk,
+        Ck,
+        vi,
+        vj,
+        wk,
+        ii,
+        jj,
+        kk,
+        bs,
+        m,
+        n,
+        d,
+        use_double=use_double,
+        hessian_indices=hessian_indices,
     )
     C_exp = torch.zeros((bs, n_exp, ht * wd), device=C.device, dtype=dtype)
-    w_exp = torch.zeros((bs, n_exp, ht * wd), device=w.device, dtype=dtype)
-    C_exp[:, non_empty_nodes] = C
-    w_exp[:, non_empty_nodes] = w
-    eta = rearrange(eta, "n h w -> 1 n (h w)")
+    w_exp = get_zeroed_buffer("w_exp", (bs, n_exp, ht * wd), w.device, dtype)
+    C_exp.index_copy_(1, ne_idx, C.to(dtype))
+    w_exp.index_copy_(1, ne_idx, w.to(dtype))
+    eta = eta.view(1, -1, ht * wd)
     # C also needs a second term C2 added on top of it, which is J2d^T * J2d
     # Since J2d is just 1, we can simply add a 1 for every single entry here
     # NOTE the original code for RGBD mode adds the derivative term +1*alpha ONLY when a prior exists
     # else it applies damping.
     # We apply both damping and the second term derivative to stay true to the objective function
     C_exp = C_exp + alpha * 1.0 + eta
-    C_exp = rearrange(C_exp, "b n hw -> b (n hw) 1 1")
-
-    # Residuals for r2(disps, s, o) (B, N, HW)
-    scaled_prior = disps_sens[:, kx_exp].view(bs, -1, ht * wd) * scales[:, kx_exp, None] + shifts[:, kx_exp, None]
-    # Prior should never be negative, i.e. clip this if s and o are diverging
-    scaled_prior.clamp_(min=1e-3)
+    C_exp = C_exp.view(bs, -1, 1, 1)
 
     ## Rescale the prior residuals according to estimated uncertainty
     # NOTE this gets rid of strong outliers like the sky or dynamic objects for scale adjustment
     # Get uncertainty weights for each edge and reduce for node
     if reweight_prior:
         # NOTE if you use this, the 2nd prior term will have much less weight in the overall objective -> Use a higher alpha value!
-        confidence = reduce_edge_weights(weight, ii, strategy="min").to(dtype)
+        confidence = reduce_edge_weights(weight, ii, strategy="min")
         # Take norm over xy axis to get single scalar
-        confidence = torch.linalg.norm(confidence, dim=2).view(bs, -1, ht * wd)
+        confidence = torch.linalg.norm(confidence, dim=-1).view(bs, -1, ht * wd)
         # Rescale to [0, 1]
         confidence = confidence / confidence.max()
-        all_conf = torch.zeros((bs, n_exp, ht * wd), device=weight.device, dtype=dtype)
-        all_conf[:, non_empty_nodes] = confidence
+        all_conf = torch.zeros((bs, n_exp, ht * wd), device=weight.device, dtype=weight.dtype)
+        all_conf.index_copy_(1, ne_idx, confidence)
         # always ensure to have enough residuals to actually optimize over
         # NOTE this is just a drastic measure to ensure a positive definite system matrix
         # if confidence.sum() < 0.1 * n * ht * wd:
         #     all_conf = torch.ones_like(all_conf, device=confidence.device, dtype=dtype)
     else:
-        all_conf = torch.ones((bs, n_exp, ht * wd), device=weight.device, dtype=dtype)
-
-    r2 = (disps[:, kx_exp].view(bs, -1, ht * wd) - scaled_prior).to(dtype)
-    w_exp[:, non_empty_nodes] = (
-        w_exp[:, non_empty_nodes] - alpha * all_conf[:, non_empty_nodes] * r2[:, non_empty_nodes]
+        all_conf = torch.ones((bs, n_exp, ht * wd), device=weight.device, dtype=weight.dtype)
+
+    # Residuals for r2(disps, s, o) (B, N, HW) and their weighted contribution to the rhs
+    # Keep the residual in float32, only the contributing nodes are cast to the system precision
+    if disps_sens_exp is None:
+        disps_sens_exp = disps_sens[:, kx_exp].view(bs, -1, ht * wd)
+    r2, wr2 = get_scaled_prior_residuals(
+        disps[:, kx_exp].view(bs, -1, ht * wd),
+        disps_sens_exp,
+        scales[:, kx_exp],
+        shifts[:, kx_exp],
+        all_conf,
+        alpha,
     )
+    w_exp.index_add_(1, ne_idx, wr2.index_select(1, ne_idx).to(dtype), alpha=-1)
 
     ### 3: Create augmented system
     ## Jacobians & Hessians of scales and shifts and mixed term with disparities
-    Js_exp, Jo_exp, wJs_exp, wJo_exp = get_regularizor_jacobians(disps_sens[:, kx_exp], all_conf, bs, n_exp, ht, wd)
-    # Manually set non-contributing nodes to zero gradients so we dont update these
-    if empty_nodes > 0:
-        Js_exp[:, :, ~non_empty_nodes] = torch.zeros(
-            (bs, n_exp * ht * wd, empty_nodes), device=Js_exp.device, dtype=dtype
-        )
-        Jo_exp[:, :, ~non_empty_nodes] = torch.zeros(
-            (bs, n_exp * ht * wd, empty_nodes), device=Jo_exp.device, dtype=dtype
-        )
-        wJs_exp[:, :, ~non_empty_nodes] = torch.zeros(
-            (bs, n_exp * ht * wd, empty_nodes), device=Js_exp.device, dtype=dtype
-        )
-        wJo_exp[:, :, ~non_empty_nodes] = torch.zeros(
-            (bs, n_exp * ht * wd, empty_nodes), device=Jo_exp.device, dtype=dtype
-        )
+    # Set non-contributing nodes to zero gradients so we dont update these
+    Js_exp, Jo_exp, wJs_exp, wJo_exp = get_regularizor_jacobians(
+        disps_sens_exp, all_conf, bs, n_exp, ht, wd, mask=non_empty_nodes if empty_nodes > 0 else None
+    )
     F, K, D, G, L, vs, vo = get_regularizor_hessians(
-        Js_exp, wJs_exp, Jo_exp, wJo_exp, r2, alpha, bs, n_exp, ht, wd, use_double=use_double
+        Js_exp,
+        wJs_exp,
+        Jo_exp,
+        wJo_exp,
+        r2,
+        alpha,
+        bs,
+        n_exp,
+        ht,
+        wd,
+        use_double=use_double,
+        out=get_regularizor_buffers(bs, n_exp, ht * wd, r2.device, dtype),
     )
     H_aug, E_aug, C_exp, v_aug, w_exp = get_augmented_hessian_and_rhs_full(
         H, E, C_exp, D, G, F, L, K, v, w_exp, vs, vo, use_double=use_double
     )
-    w_exp = rearrange(w_exp, "b n hw -> b (n hw) 1 1")
+    w_exp = w_exp.view(bs, -1, 1, 1)
 
     ### 4: Solve whole system with dX, ds, do, dZ ###
-    # NOTE this needs to be solve with LU decomposition since because of E,
-    # the resulting Schur complement S is not positive definite
-    dxso, dz = schur_solve(H_aug, E_aug, C_exp, v_aug, w_exp, ep=ep, lm=lm, solver="lu", use_double=use_double)
-    dx, ds, do = dxso[:, : d * m], dxso[:, d * m : d * m + n], dxso[:, d * m + n :]
+    # NOTE because of E, the resulting Schur complement S is not always positive definite
+    # We only pay for the LU decomposition when the Cholesky decomposition actually fails
+    dxso, dz = schur_solve(H_aug, E_aug, C_exp, v_aug, w_exp, ep=ep, lm=lm, solver="auto", use_double=use_double)
     dxso, dz = dxso.float(), dz.float()  # Finally always convert to float32 like system!
-    dz = rearrange(dz, "b (n h w) -> b n h w", n=n, h=ht, w=wd)
-    dx = rearrange(dx, "b (m d) 1 -> b m d", m=m, d=d)
+    dx, ds, do = dxso[:, : d * m], dxso[:, d * m : d * m + n], dxso[:, d * m + n :]
+    dz = dz.view(bs, n, ht, wd)
+    dx = dx.view(bs, m, d)
 
     ### 4: apply retraction ###
-    # Update only un-fixed poses
-    poses1, poses2 = poses[:, :fixedp], poses[:, fixedp:]
-    poses2 = poses2.retr(dx)
-    poses = lietorch.cat([poses1, poses2], dim=1)
+    # Update only un-fixed global poses in-place
+    all_poses[:, fixedp:t1] = all_poses[:, fixedp:t1].retr(dx)
 
-    # Update global poses, disparities, scales and shifts
-    all_poses[:, :t1] = poses
-    all_disps[:, :t1] = additive_retr(disps, dz, kx)
-    all_scales[:, :t1] = additive_retr(scales, ds.squeeze(-1), kx)
-    all_shifts[:, :t1] = additive_retr(shifts, do.squeeze(-1), kx)
+    # Update global disparities, scales and shifts
+    additive_retr_(disps, dz, kx)
+    additive_retr_(scales, ds.squeeze(-1), kx)
+    additive_retr_(shifts, do.squeeze(-1), kx)
 
 
 # NOTE this could be unstable as the weights are learned to optimize camera poses
@@ -823,7 +1134,7 @@ def reduce_edge_weights(weights: torch.Tensor, ii: torch.Tensor, strategy: str =
 
     args:
     ---
-    weight [torch.Tensor]: Weight tensor of shape [len(nodes), 2, ht // 8, wd // 8]. Optimization weights for bundle adjustment.
+    weight [torch.Tensor]: Weight tensor of shape [len(nodes), ht // 8, wd // 8, 2]. Optimization weights for bundle adjustment.
         Each point is a vector [u_x, u_y] \in [0, 1], which measures the uncertainty for x- and y-components.
     ii [torch.Tensor]: Indices of source nodes (We go from i to j, i.e. we have edges e_ij) with same length as jj.
     strategy [str]: How to reduce across edges. Choices: (avg, max). Given multiple uncertainty weight maps for
@@ -866,16 +1177,18 @@ def BA_prior_no_motion(
     alpha: float = 0.01,
     reweight_prior: bool = False,
     use_double: bool = False,
+    compute_dtype: torch.dtype = torch.float32,
+    window_nodes: Optional[Tuple[torch.Tensor, ...]] = None,
+    disps_sens_exp: Optional[torch.Tensor] = None,
 ):
     """Optimize the geometry of the scene with a depth prior. The prior is scale ambiguous, i.e. we add scale and shift
     parameters in the regularior term to optimize the depth of the scene. This is useful in combination with monocular depth estimation.
 
     NOTE: we fix the camera poses in order to not make the problem ill-posed
+    NOTE: the system is always assembled and solved in float32, use_double applies one step of iterative refinement
+    in float64 instead. The scale/shift system decouples per frame, so this is enough to recover the precision.
     """
-    if use_double:
-        dtype = torch.float64
-    else:
-        dtype = torch.float32
+    dtype = torch.float32
 
     disps, poses, intrinsics, disps_sens, scales, shifts = get_keyframe_window(
         all_poses, all_intrinsics, all_disps, t1, all_disps_sens, all_scales, all_shifts
@@ -888,11 +1201,11 @@ def BA_prior_no_motion(
     coords, valid, (Ji, Jj, Jz) = projective_transform(
         poses, disps, intrinsics, ii, jj, jacobian=True, use_double=use_double
     )
-    Jz, Ji, Jj = -Jz.to(dtype), -Ji.to(dtype), -Jj.to(dtype)
+    Jz, Ji, Jj = -Jz, -Ji, -Jj  # Accumulate in float32, the blocks are cast to dtype afterwards
 
     ### 2: Assemble linear system ###
     _, _, _, _, _, _, Ck, _, _, wk = get_hessian_and_rhs(
-        Jz, Ji, Jj, target, weight, coords, valid, use_double=use_double
+        Jz, Ji, Jj, target, weight, coords, valid, use_double=False, compute_dtype=compute_dtype
     )
 
     ## Construct larger sparse system
@@ -902,95 +1215,89 @@ def BA_prior_no_motion(
     # What happens under the hood is that if a value in ii is not in kx_exp, then we will have a respective zero term in C since that node is not contributing to the total energy
     # This does not work with scatter sum code, so we need to pad the array in retrospect here instead of how its done in the CUDA code
     # NOTE we normally dont need to do this but we choose compatibility with the update operator that can also use the CUDA kernel
-    kx, kk = torch.unique(ii, return_inverse=True)
-    ts = torch.arange(t0, t1).long().to(ii.device)
-    kx_exp, kk_exp = torch.unique(torch.cat([ts, ii], dim=0), return_inverse=True)
+    if window_nodes is None:
+        window_nodes = get_window_nodes(ii, t0, t1)
+    kx, kk, kx_exp, non_empty_nodes, ne_idx = window_nodes
 
     n = len(kx)  # Actual unique key frame nodes to be updated
     n_exp = len(kx_exp)  # Expand with [t0, t1] to include all nodes in interval even if they dont contribute
     empty_nodes = n_exp - n
-    non_empty_nodes = torch.isin(kx_exp, kx)
 
     C = safe_scatter_add_vec(Ck, kk, n)
     w = safe_scatter_add_vec(wk, kk, n)
     C_exp = torch.zeros((bs, n_exp, ht * wd), device=C.device, dtype=dtype)
-    w_exp = torch.zeros((bs, n_exp, ht * wd), device=w.device, dtype=dtype)
-    C_exp[:, non_empty_nodes] = C
-    w_exp[:, non_empty_nodes] = w
+    w_exp = get_zeroed_buffer("w_exp", (bs, n_exp, ht * wd), w.device, dtype)
+    C_exp.index_copy_(1, ne_idx, C.to(dtype))
+    w_exp.index_copy_(1, ne_idx, w.to(dtype))
 
-    eta = rearrange(eta, "n h w -> 1 n (h w)")
+    eta = eta.view(1, -1, ht * wd)
     C_exp = C_exp + alpha * 1.0 + eta
-    C_exp = rearrange(C_exp, "b n hw -> b (n hw) 1 1")
 
-    scaled_prior = disps_sens[:, kx_exp].view(bs, -1, ht * wd) * scales[:, kx_exp, None] + shifts[:, kx_exp, None]
-    # Prior should never be negative, i.e. clip this if s and o are diverging
-    scaled_prior.clamp_(min=1e-3)
+    if alpha == 0:
+        # Without the prior term scales and shifts do not appear in the objective, i.e. F, K, vs, vo vanish
+        # and the full solve would return ds = do = 0. The structure update then only depends on the diagonal C
+        dz = (w_exp / C_exp).float().view(bs, n_exp, ht, wd)
+        additive_retr_(disps, dz, kx_exp)
+        return
 
     ## Rescale the prior residuals according to estimated uncertainty
     # NOTE this gets rid of strong outliers like the sky or dynamic objects for scale adjustment
     # Get uncertainty weights for each edge and reduce for node
     if reweight_prior:
         # NOTE if you use this, the 2nd prior term will have much less weight in the overall objective -> Use a higher alpha value!
-        confidence = reduce_edge_weights(weight, ii, strategy="min").to(dtype)
+        confidence = reduce_edge_weights(weight, ii, strategy="min")
         # Take norm over xy axis to get single scalar
-        confidence = torch.linalg.norm(confidence, dim=2).reshape(bs, len(kx_exp), ht * wd)
+        confidence = torch.linalg.norm(confidence, dim=-1).view(bs, -1, ht * wd)
         # Rescale to [0, 1]
         confidence = confidence / confidence.max()
-        all_conf = torch.zeros((bs, n_exp, ht * wd), device=weight.device, dtype=dtype)
-        all_conf[:, non_empty_nodes] = confidence
+        all_conf = torch.zeros((bs, n_exp, ht * wd), device=weight.device, dtype=weight.dtype)
+        all_conf.index_copy_(1, ne_idx, confidence)
         # always ensure to have enough residuals to actually optimize over
         # NOTE this is just a drastic measure to stabilize the system in case there are no confident matches
         if confidence.sum() < 0.15 * n * ht * wd:
-            all_conf = torch.ones_like(all_conf, device=confidence.device, dtype=dtype)
+            all_conf = torch.ones_like(all_conf)
     else:
-        all_conf = torch.ones((bs, n_exp, ht * wd), device=weight.device, dtype=dtype)
-
-    r2 = (disps[:, kx_exp].view(bs, -1, ht * wd) - scaled_prior).to(dtype)
-    w_exp[:, non_empty_nodes] = (
-        w_exp[:, non_empty_nodes] - alpha * all_conf[:, non_empty_nodes] * r2[:, non_empty_nodes]
+        all_conf = torch.ones((bs, n_exp, ht * wd), device=weight.device, dtype=weight.dtype)
+
+    # Residuals for r2(disps, s, o) (B, N, HW) and their weighted contribution to the rhs
+    # Keep the residual in float32, only the contributing nodes are cast to the system precision
+    if disps_sens_exp is None:
+        disps_sens_exp = disps_sens[:, kx_exp].view(bs, -1, ht * wd)
+    r2, wr2 = get_scaled_prior_residuals(
+        disps[:, kx_exp].view(bs, -1, ht * wd),
+        disps_sens_exp,
+        scales[:, kx_exp],
+        shifts[:, kx_exp],
+        all_conf,
+        alpha,
     )
-    w_exp = rearrange(w_exp, "b n hw -> b (n hw) 1 1")
+    w_exp.index_add_(1, ne_idx, wr2.index_select(1, ne_idx).to(dtype), alpha=-1)
 
     ### 3: Create augmented system
     Js_exp, Jo_exp, wJs_exp, wJo_exp = get_regularizor_jacobians(
-        disps_sens[:, kx_exp], all_conf, bs, n_exp, ht, wd, use_double=use_double
+        disps_sens_exp, all_conf, bs, n_exp, ht, wd, mask=non_empty_nodes if empty_nodes > 0 else None
     )
-    if empty_nodes > 0:
-        Js_exp[:, :, ~non_empty_nodes] = torch.zeros(
-            (bs, n_exp * ht * wd, empty_nodes), device=Js_exp.device, dtype=dtype
-        )
-        Jo_exp[:, :, ~non_empty_nodes] = torch.zeros(
-            (bs, n_exp * ht * wd, empty_nodes), device=Jo_exp.device, dtype=dtype
-        )
-        wJs_exp[:, :, ~non_empty_nodes] = torch.zeros(
-            (bs, n_exp * ht * wd, empty_nodes), device=Js_exp.device, dtype=dtype
-        )
-        wJo_exp[:, :, ~non_empty_nodes] = torch.zeros(
-            (bs, n_exp * ht * wd, empty_nodes), device=Jo_exp.device, dtype=dtype
-        )
     F, K, D, G, L, vs, vo = get_regularizor_hessians(
-        Js_exp, wJs_exp, Jo_exp, wJo_exp, r2, alpha, bs, n_exp, ht, wd, use_double=use_double
+        Js_exp,
+        wJs_exp,
+        Jo_exp,
+        wJo_exp,
+        r2,
+        alpha,
+        bs,
+        n_exp,
+        ht,
+        wd,
+        use_double=False,
+        out=get_regularizor_buffers(bs, n_exp, ht * wd, r2.device, dtype),
     )
-
-    # Define new H and E block
-    DL = torch.cat([D, L], dim=2)
-    LG = torch.cat([L.mT, G], dim=2)  # Since L is diagonal, L^T = L
-    H = torch.cat([DL, LG], dim=1)
-    E = torch.cat([F, K], dim=1)
-    v = torch.cat([vs, vo], dim=1)
-
-    ### 4: Solve whole system with dX, ds, do, dZ ###
-    dso, dz, was_success = schur_solve(H, E, C_exp, v, w_exp, ep=ep, lm=lm, return_state=True, use_double=use_double)
-    if not was_success:
-        # print(colored("Entering debug mode ...", "red"))
-        # ipdb.set_trace()
-        dso, dz = schur_solve(H, E, C_exp, v, w_exp, ep=ep, lm=lm, solver="lu", use_double=use_double)
-
-    dso, dz = dso.float(), dz.float()  # Finally always work in float32 like main system!
-    ds, do = dso[:, :n_exp], dso[:, n_exp:]
-    dz = rearrange(dz, "b (n h w) -> b n h w", n=n_exp, h=ht, w=wd)
+    ### 4: Solve whole system with ds, do, dZ ###
+    # D, G, L are diagonal and F, K block diagonal per frame, so the Schur complement decouples into a 2x2 system
+    # per frame. Solving these in closed form also covers the indefinite case, where we needed the LU fallback before
+    ds, do, dz = solve_prior_system(D, G, L, F, K, C_exp, vs, vo, w_exp, ep=ep, lm=lm, refine=use_double)
+    dz = dz.view(bs, n_exp, ht, wd)
 
     ### 4: apply retraction ###
-    all_disps[:, :t1] = additive_retr(disps, dz, kx_exp)
-    all_scales[:, :t1] = additive_retr(scales, ds.squeeze(-1), kx_exp)
-    all_shifts[:, :t1] = additive_retr(shifts, do.squeeze(-1), kx_exp)
+    additive_retr_(disps, dz, kx_exp)
+    additive_retr_(scales, ds, kx_exp)
+    additive_retr_(shifts, do, kx_exp)
@@ -1,6 +1,5 @@
+from typing import Tuple
 import torch
-from termcolor import colored
-import ipdb
 from einops import einsum, rearrange
 
 """
@@ -22,41 +21,33 @@ In case we detect an overflow, we simply clip the Jacobians / Gradients, which e
 
 
 def is_positive_definite(matrix: torch.Tensor, eps=2e-5) -> bool:
-    """Check if a Matrix is positive definite by checking symmetry looking at the eigenvalues.
-
-    NOTE This is in reality less efficient then performing a test Cholesky decomposition and checking if it fails
-    NOTE A rigorous test would also include the submatrix determinants
+    """Check if a Matrix is positive definite by checking symmetry and attempting a Cholesky decomposition.
+    A symmetric matrix is positive definite iff the decomposition succeeds, which is much cheaper than computing eigenvalues.
     """
-    return bool((abs(matrix - matrix.mT) < eps).all() and (torch.linalg.eigvals(matrix).real >= 0).all())
+    _, info = torch.linalg.cholesky_ex(matrix)
+    return bool((abs(matrix - matrix.mT) < eps).all() and (info == 0).all())
 
 
+# NOTE the solvers use the *_ex variants of the decompositions, which do not check for errors and therefore do not
+# synchronize the device with the CPU. Failed decompositions are reported by a boolean success tensor of shape (B,)
+# and their solution is set to zero, so we dont crash training if the decomposition fails
 class LUSolver(torch.autograd.Function):
     # TODO is this really correct? we apply the same derivative like in CholeskySolver
     @staticmethod
     def forward(ctx, H, b):
-        # don't crash training if decomp fails
-        try:
-            lu, pivots = torch.linalg.lu_factor(H)
-            xs = torch.linalg.lu_solve(lu, pivots, b)
-            ctx.save_for_backward(lu, pivots, xs)
-            ctx.failed = False
-            success = True
-        except Exception as e:
-            print(colored("Warning. LU Decomposition failed!", "red"))
-            ctx.failed = True
-            success = False
-            xs = torch.zeros_like(b)
-
+        lu, pivots, info = torch.linalg.lu_factor_ex(H)
+        success = info == 0
+        mask = success.view(-1, *([1] * (b.ndim - 1)))
+        xs = torch.where(mask, torch.linalg.lu_solve(lu, pivots, b), 0.0)
+        ctx.save_for_backward(lu, pivots, xs, mask)
+        ctx.mark_non_differentiable(success)
         return xs, success
 
     @staticmethod
-    def backward(ctx, grad_x):
-        if ctx.failed:
-            return None, None
-
-        lu, pivots, xs = ctx.saved_tensors
+    def backward(ctx, grad_x, grad_success):
+        lu, pivots, xs, mask = ctx.saved_tensors
         # P * H = LU with P being the pivots
-        dz = torch.linalg.lu_solve(lu, pivots, grad_x)
+        dz = torch.where(mask, torch.linalg.lu_solve(lu, pivots, grad_x), 0.0)
         dH = -torch.matmul(xs, dz.transpose(-1, -2)).to(lu.dtype)
 
         return dH, dz
@@ -65,28 +56,18 @@ class LUSolver(torch.autograd.Function):
 class CholeskySolver(torch.autograd.Function):
     @staticmethod
     def forward(ctx, H, b):
-        # don't crash training if cholesky decomp fails
-        try:
-            U = torch.linalg.cholesky(H)
-            xs = torch.cholesky_solve(b, U)
-            ctx.save_for_backward(U, xs)
-            ctx.failed = False
-            success = True
-        except Exception as e:
-            print(colored("Warning. Cholesky Decomposition failed!", "red"))
-            success = False
-            ctx.failed = True
-            xs = torch.zeros_like(b)
-
+        U, info = torch.linalg.cholesky_ex(H)
+        success = info == 0
+        mask = success.view(-1, *([1] * (b.ndim - 1)))
+        xs = torch.where(mask, torch.cholesky_solve(b, U), 0.0)
+        ctx.save_for_backward(U, xs, mask)
+        ctx.mark_non_differentiable(success)
         return xs, success
 
     @staticmethod
-    def backward(ctx, grad_x):
-        if ctx.failed:
-            return None, None
-
-        U, xs = ctx.saved_tensors
-        dz = torch.cholesky_solve(grad_x, U)
+    def backward(ctx, grad_x, grad_success):
+        U, xs, mask = ctx.saved_tensors
+        dz = torch.where(mask, torch.cholesky_solve(grad_x, U), 0.0)
         dH = -torch.matmul(xs, dz.transpose(-1, -2)).to(xs.dtype)
 
         return dH, dz
@@ -129,22 +110,26 @@ def block_matmul(A: torch.Tensor, B: torch.Tensor) -> torch.Tensor:
 
 def cholesky_block_solve(
     H: torch.Tensor, b: torch.Tensor, ep: float = 0.1, lm: float = 1e-4, use_double: bool = False
-) -> torch.Tensor:
-    """solve normal equations for block structure matrices of shape (n1 n2 d1 d2)"""
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """solve normal equations for block structure matrices of shape (n1 n2 d1 d2)
+
+    NOTE batch elements where the decomposition failed get a zero update and are marked in the returned success mask
+    """
     if use_double:
         dtype = torch.float64
     else:
         dtype = torch.float32
 
     bs, n, _, d, _ = H.shape
-    I = torch.eye(d, dtype=dtype).to(H.device)
-    H = H.to(dtype) + (ep + lm * H.to(dtype)) * I  # Damp H
+    H = H.to(dtype)
+    # Damp the diagonal of each block in-place instead of multiplying with a broadcasted identity
+    H.diagonal(dim1=-2, dim2=-1).mul_(1 + lm).add_(ep)
 
     H = rearrange(H, "b n1 n2 d1 d2 -> b (n1 d1) (n2 d2)")
     b = rearrange(b, "b n d -> b (n d) 1")
 
-    x = CholeskySolver.apply(H, b)
-    return rearrange(x, "b (n1 d1) 1 -> b n1 d1", n1=n, d1=d)
+    x, success = CholeskySolver.apply(H, b)
+    return rearrange(x, "b (n1 d1) 1 -> b n1 d1", n1=n, d1=d), success
 
 
 def schur_block_solve(
@@ -175,7 +160,7 @@ def schur_block_solve(
     if structure_only:
         dZ = (Q * w).view(b, -1, 1, 1)
         if return_state:
-            return dZ, success
+            return dZ, True  # C is diagonal, so this cannot fail
         else:
             return dZ
 
@@ -183,6 +168,9 @@ def schur_block_solve(
         S = H - block_matmul(EQ, Et)
         y = v - block_matmul(EQ, w.unsqueeze(dim=2))
         dX, success = cholesky_block_solve(S, y, ep=ep, lm=lm, use_double=use_double)
+        if return_state:
+            # Only synchronize with the CPU when the caller actually asks for the state
+            success = bool(success.all())
 
         if motion_only:
             if return_state:
@@ -221,8 +209,9 @@ def schur_solve(
     H and the Schur complement S should be positive definite, so we can invert them using Cholesky decomposition.
     However, for some problems this is not the case! When optimizing poses, structure, scale and shift we notice
     that S will not be positive definite, but still invertible. In this case we use LU decomposition instead.
+    solver="auto" tries the cheaper Cholesky decomposition first and only falls back to LU if it fails.
     """
-    if solver == "cholesky":
+    if solver in ["cholesky", "auto"]:
         Solver = CholeskySolver
     else:
         Solver = LUSolver
@@ -240,11 +229,20 @@ def schur_solve(
         return dZ.float()
 
     EQ = E * Q[:, None]
-    S = H - torch.matmul(EQ, E.mT).to(dtype)
-    y = v - torch.matmul(EQ, w.squeeze(dim=-1)).to(dtype)
-
-    A = S + (ep + lm * S) * torch.eye(S.shape[1], device=S.device, dtype=dtype)  # Damping
+    # Fuse the products into the subtraction, i.e. S = H - EQ E^T and y = v - EQ w in a single kernel each
+    H, v, EQ, E, w = H.to(dtype), v.to(dtype), EQ.to(dtype), E.to(dtype), w.to(dtype)
+    S = torch.baddbmm(H, EQ, E.mT, alpha=-1)
+    y = torch.baddbmm(v, EQ, w.view(bs, -1, 1), alpha=-1)
+
+    # Damping, S is a fresh tensor so we can scale its diagonal in-place instead of adding a full identity
+    A = S
+    A.diagonal(dim1=-2, dim2=-1).mul_(1 + lm).add_(ep)
     dX, success = Solver.apply(A, y)
+    if solver == "auto" and not bool(success.all()):
+        dX, success = LUSolver.apply(A, y)
+    if return_state:
+        # Only synchronize with the CPU when the caller actually asks for the state
+        success = bool(success.all())
 
     if motion_only:
         if return_state:
@@ -257,3 +255,76 @@ def schur_solve(
         return dX, dZ, success
     else:
         return dX, dZ
+
+
+def schur_solve_block_diagonal(
+    D: torch.Tensor,
+    G: torch.Tensor,
+    L: torch.Tensor,
+    F: torch.Tensor,
+    K: torch.Tensor,
+    C: torch.Tensor,
+    vs: torch.Tensor,
+    vo: torch.Tensor,
+    w: torch.Tensor,
+    ep: float = 0.1,
+    lm: float = 1e-4,
+    refine: bool = False,
+    return_state: bool = False,
+):
+    """Solve the scale, shift and structure system
+
+        D    L    F  | ds      vs
+        L    G    K  | do   =  vo
+        F^T  K^T  C  | dz      w
+
+    by the Schur complement, where D, G, L are diagonal (B, N) and F, K are block diagonal per frame, i.e.
+    each pixel only couples with the scale and shift of its own frame (B, N, HW). Since C is diagonal as well,
+    the Schur complement decouples into a 2x2 system for each frame, which we solve in closed form
+    without ever materializing the dense (2N x 2N) or (2N x NHW) blocks.
+
+    If refine is set, the system is solved in the precision of the inputs (usually float32) and we apply one step of
+    iterative refinement, where the residual of the damped system is computed in float64. This is a lot cheaper than
+    assembling and solving the whole system in float64.
+    """
+    Q = 1.0 / C  # Since C is diagonal we can just divide for inversion
+    FQ, KQ = F * Q, K * Q
+
+    # Diagonal entries of the Schur complement S = H - E C^-1 E^T per frame
+    S_ss = D - (FQ * F).sum(dim=-1)
+    S_so = L - (FQ * K).sum(dim=-1)
+    S_oo = G - (KQ * K).sum(dim=-1)
+
+    # Damping only acts on the diagonal of S
+    damp_ss, damp_oo = lm * S_ss + ep, lm * S_oo + ep
+    S_ss, S_oo = S_ss + damp_ss, S_oo + damp_oo
+    # Invert each 2x2 block [[S_ss, S_so], [S_so, S_oo]] in closed form
+    det = S_ss * S_oo - S_so * S_so
+
+    def solve(rs: torch.Tensor, ro: torch.Tensor, rz: torch.Tensor):
+        y_s = rs - (FQ * rz).sum(dim=-1)
+        y_o = ro - (KQ * rz).sum(dim=-1)
+        ds = (S_oo * y_s - S_so * y_o) / det
+        do = (S_ss * y_o - S_so * y_s) / det
+        dZ = Q * (rz - F * ds[..., None] - K * do[..., None])
+        return ds, do, dZ
+
+    ds, do, dZ = solve(vs, vo, w)
+
+    if refine:
+        # Residual of the damped system in float64, the damping on S is equivalent to damping D and G
+        dsd, dod, dZd = ds.double(), do.double(), dZ.double()
+        Fd, Kd = F.double(), K.double()
+        rs = vs.double() - (D.double() + damp_ss.double()) * dsd - L.double() * dod - (Fd * dZd).sum(dim=-1)
+        ro = vo.double() - L.double() * dsd - (G.double() + damp_oo.double()) * dod - (Kd * dZd).sum(dim=-1)
+        rz = w.double() - Fd * dsd[..., None] - Kd * dod[..., None] - C.double() * dZd
+        # Solve for the correction with the low precision factorization
+        cs, co, cZ = solve(rs.to(ds.dtype), ro.to(ds.dtype), rz.to(ds.dtype))
+        ds, do, dZ = ds + cs, do + co, dZ + cZ
+
+    if return_state:
+        # A symmetric 2x2 matrix is positive definite iff its first entry and determinant are positive
+        success = bool(((S_ss > 0) & (det > 0)).all())
+        return ds, do, dZ, success
+    else:
+        return ds, do, dZ
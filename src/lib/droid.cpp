@@ -48,6 +48,14 @@ torch::Tensor iproj_cuda(
   torch::Tensor disps,
   torch::Tensor intrinsics);
 
+std::vector<torch::Tensor> iproj_filter_cuda(
+  torch::Tensor poses,
+  torch::Tensor disps,
+  torch::Tensor intrinsics,
+  torch::Tensor counter,
+  torch::Tensor thresh,
+  const float min_count);
+
 std::vector<torch::Tensor> ba_cuda(
     torch::Tensor poses,
     torch::Tensor disps,
@@ -180,6 +188,23 @@ torch::Tensor iproj(
 }
 
 
+std::vector<torch::Tensor> iproj_filter(
+    torch::Tensor poses,
+    torch::Tensor disps,
+    torch::Tensor intrinsics,
+    torch::Tensor counter,
+    torch::Tensor thresh,
+    const float min_count) {
+  CHECK_INPUT(poses);
+  CHECK_INPUT(disps);
+  CHECK_INPUT(intrinsics);
+  CHECK_INPUT(counter);
+  CHECK_INPUT(thresh);
+
+  return iproj_filter_cuda(poses, disps, intrinsics, counter, thresh, min_count);
+}
+
+
 // c++ python binding
 std::vector<torch::Tensor> corr_index_forward(
     torch::Tensor volume,
@@ -255,6 +280,7 @@ PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
   m.def("projmap", &projmap, "projmap");
   m.def("depth_filter", &depth_filter, "depth_filter");
   m.def("iproj", &iproj, "back projection");
+  m.def("iproj_filter", &iproj_filter, "back projection with visualization filter");
 
   // correlation volume kernels
   m.def("altcorr_forward", &altcorr_forward, "ALTCORR forward");
@@ -1256,6 +1256,85 @@ __global__ void iproj_kernel(
 
 
 
+__global__ void iproj_filter_kernel(
+    const torch::PackedTensorAccessor32<float,2,torch::RestrictPtrTraits> poses,
+    const torch::PackedTensorAccessor32<float,3,torch::RestrictPtrTraits> disps,
+    const torch::PackedTensorAccessor32<float,1,torch::RestrictPtrTraits> intrinsics,
+    const torch::PackedTensorAccessor32<float,3,torch::RestrictPtrTraits> counter,
+    const torch::PackedTensorAccessor32<float,1,torch::RestrictPtrTraits> thresh,
+    const float min_count,
+    torch::PackedTensorAccessor32<float,4,torch::RestrictPtrTraits> points,
+    torch::PackedTensorAccessor32<bool,3,torch::RestrictPtrTraits> valid)
+
+{
+
+  const int block_id = blockIdx.x;
+  const int index = blockIdx.y * blockDim.x + threadIdx.x;
+
+  const int ht = disps.size(1);
+  const int wd = disps.size(2);
+
+  __shared__ float fx;
+  __shared__ float fy;
+  __shared__ float cx;
+  __shared__ float cy;
+
+  __shared__ float t[3];
+  __shared__ float q[4];
+
+  if (threadIdx.x == 0) {
+    fx = intrinsics[0];
+    fy = intrinsics[1];
+    cx = intrinsics[2];
+    cy = intrinsics[3];
+  }
+
+  __syncthreads();
+
+  // load poses from global memory
+  if (threadIdx.x < 3) {
+    t[threadIdx.x] = poses[block_id][threadIdx.x];
+  }
+
+  if (threadIdx.x < 4) {
+    q[threadIdx.x] = poses[block_id][threadIdx.x+3];
+  }
+
+  __syncthreads();
+
+  // points 
+  float Xi[4];
+  float Xj[4];
+
+  if (index < ht*wd) {
+    const int i = index / wd;
+    const int j = index % wd;
+
+    const float ui = static_cast<float>(j);
+    const float vi = static_cast<float>(i);
+    const float di = disps[block_id][i][j];
+
+    // only keep points that are consistent across multiple views and not too close by
+    valid[block_id][i][j] = (counter[block_id][i][j] >= min_count) && (di > thresh[block_id]);
+
+    // homogenous coordinates
+    Xi[0] = (ui - cx) / fx;
+    Xi[1] = (vi - cy) / fy;
+    Xi[2] = 1;
+    Xi[3] = di;
+
+    // transform homogenous point
+    actSE3(t, q, Xi, Xj);
+
+    points[block_id][i][j][0] = Xj[0] / Xj[3];
+    points[block_id][i][j][1] = Xj[1] / Xj[3];
+    points[block_id][i][j][2] = Xj[2] / Xj[3];
+
+  }
+}
+
+
+
 __global__ void accum_kernel(
     const torch::PackedTensorAccessor32<float,2,torch::RestrictPtrTraits> inps,
     const torch::PackedTensorAccessor32<long,1,torch::RestrictPtrTraits> ptrs,
@@ -2603,3 +2682,37 @@ torch::Tensor iproj_cuda(
   return points;
 
 }
+
+
+std::vector<torch::Tensor> iproj_filter_cuda(
+    torch::Tensor poses,
+    torch::Tensor disps,
+    torch::Tensor intrinsics,
+    torch::Tensor counter,
+    torch::Tensor thresh,
+    const float min_count)
+{
+
+  const int nm = disps.size(0);
+  const int ht = disps.size(1);
+  const int wd = disps.size(2);
+
+  auto opts = disps.options();
+  torch::Tensor points = torch::zeros({nm, ht, wd, 3}, opts);
+  torch::Tensor valid = torch::zeros({nm, ht, wd}, opts.dtype(torch::kBool));
+
+  dim3 blocks(nm, NUM_BLOCKS(ht * wd));
+
+  iproj_filter_kernel<<<blocks, THREADS>>>(
+    poses.packed_accessor32<float,2,torch::RestrictPtrTraits>(),
+    disps.packed_accessor32<float,3,torch::RestrictPtrTraits>(),
+    intrinsics.packed_accessor32<float,1,torch::RestrictPtrTraits>(),
+    counter.packed_accessor32<float,3,torch::RestrictPtrTraits>(),
+    thresh.packed_accessor32<float,1,torch::RestrictPtrTraits>(),
+    min_count,
+    points.packed_accessor32<float,4,torch::RestrictPtrTraits>(),
+    valid.packed_accessor32<bool,3,torch::RestrictPtrTraits>());
+
+  return {points, valid};
+
+}
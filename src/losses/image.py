@@ -1,4 +1,5 @@
 from typing import List, Optional, Tuple, Union
+from functools import lru_cache
 import warnings
 import ipdb
 
@@ -127,6 +128,20 @@ def _fspecial_gauss_1d(size: int, sigma: float) -> torch.Tensor:
     return g.unsqueeze(0).unsqueeze(0)
 
 
+@lru_cache(maxsize=8)
+def _get_window(
+    win_size: int, win_sigma: float, channel: int, spatial_dims: int, device: torch.device, dtype: torch.dtype
+) -> torch.Tensor:
+    r"""Create the repeated 1-D gauss kernel once per configuration and device, since we call ssim in a loop.
+    Returns:
+        torch.Tensor: 1D kernel (channel x 1 x [1 x] 1 x size)
+    """
+    # NOTE the window could be created first during evaluation, we need a normal tensor in case we train afterwards
+    with torch.inference_mode(False):
+        win = _fspecial_gauss_1d(win_size, win_sigma)
+        return win.repeat([channel, 1] + [1] * spatial_dims).to(device, dtype=dtype)
+
+
 def gaussian_filter(input: torch.Tensor, win: torch.Tensor) -> torch.Tensor:
     r"""Blur input with 1-D kernel
     Args:
@@ -273,8 +288,7 @@ def ssim(
         raise ValueError("Window size should be odd.")
 
     if win is None:
-        win = _fspecial_gauss_1d(win_size, win_sigma)
-        win = win.repeat([X.shape[1]] + [1] * (len(X.shape) - 1))
+        win = _get_window(win_size, win_sigma, X.shape[1], len(X.shape) - 2, X.device, X.dtype)
 
     ssim_per_channel, cs = _ssim(X, Y, data_range=data_range, win=win, size_average=False, K=K, mask=mask)
     if nonnegative_ssim:
@@ -348,8 +362,7 @@ def ms_ssim(
     weights_tensor = X.new_tensor(weights)
 
     if win is None:
-        win = _fspecial_gauss_1d(win_size, win_sigma)
-        win = win.repeat([X.shape[1]] + [1] * (len(X.shape) - 1))
+        win = _get_window(win_size, win_sigma, X.shape[1], len(X.shape) - 2, X.device, X.dtype)
 
     levels = weights_tensor.shape[0]
     mcs = []
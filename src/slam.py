@@ -1,21 +1,20 @@
 import os
 import ipdb
 import gc
+import queue
 from time import sleep, time, perf_counter
 from typing import List, Optional, Tuple
 from tqdm import tqdm
 import logging
-from copy import deepcopy
 from termcolor import colored
-from collections import OrderedDict
 from omegaconf import DictConfig
 
 import cv2
 import numpy as np
-import pandas as pd
 
 import torch
 import torch.multiprocessing as mp
+from torch.utils.data import DataLoader
 from lietorch import SE3
 
 from .droid_net import DroidNet
@@ -23,7 +22,7 @@ from .frontend import FrontendWrapper
 from .backend import BackendWrapper
 from .depth_video import DepthVideo
 from .geom import pose_distance
-from .visualization import droid_visualization, depth2rgb, uncertainty2rgb
+from .visualization import droid_visualization, tensor2bgr
 from .trajectory_filler import PoseTrajectoryFiller
 from .loop_detection import LoopDetector, merge_candidates
 from .gaussian_mapping import GaussianMapper
@@ -32,7 +31,7 @@ from .gaussian_splatting.camera_utils import Camera
 from .gaussian_splatting import eval_utils
 from .gaussian_splatting.utils.graphics_utils import getProjectionMatrix2, focal2fov
 from .gaussian_splatting.gui import gui_utils, slam_gui
-from .utils import clone_obj, get_all_queue
+from .utils import clone_obj, collate_single_item, get_all_queue, SharedFrameBuffer, FakeQueue
 
 # A logger for this file
 log = logging.getLogger(__name__)
@@ -146,7 +145,12 @@ class SLAM:
 
         ### Multi-threading stuff
         # Objects for communicating between processes
-        self.input_pipe = mp.Queue()  # Communicate data from Stream -> main thread
+        # NOTE frames are written into preallocated shared memory slots instead of being pickled through a mp.Queue
+        if cfg.show_stream:
+            H_out, W_out = int(cfg.data.cam.H_out), int(cfg.data.cam.W_out)
+            self.input_pipe = SharedFrameBuffer(4, (1, 3, H_out, W_out), (H_out, W_out))  # Stream -> main thread
+        else:
+            self.input_pipe = FakeQueue()
         self.mapping_queue = mp.Queue()  # Communicate data between Mapping <-> main thread
         self.received_mapping = mp.Event()  # Ensure we have received the mapping state before moving on
         self.loop_queue = mp.Queue()  # Communicate loop candidates between Loop Detection -> Backend thread
@@ -167,6 +171,12 @@ class SLAM:
         self.loop_detection_finished = torch.zeros((1)).int().share_memory_()
         self.visualizing_finished = torch.zeros((1)).int().share_memory_()
         self.mapping_visualizing_finished = torch.zeros((1)).int().share_memory_()
+        # NOTE the counters above are only for bookkeeping, processes wait on these events so the OS can park them
+        self.lifetime_lock = mp.Lock()
+        self.all_started = mp.Event()
+        self.all_done = mp.Event()
+        self.gaussian_mapping_done = mp.Event()
+        self.mapping_visualizing_done = mp.Event()
 
         # Synchronization objects
         self.backend_freq = self.cfg.get("backend_every", 10)  # Run the backend every k frontend calls
@@ -226,14 +236,28 @@ class SLAM:
             if self.cfg.mapper_every > self.cfg.backend_every:
                 print(colored("Warning. Mapping is run less often than backend!", "red"))
 
+    def thread_started(self) -> None:
+        """Register a started process and release everyone waiting once all processes are running."""
+        with self.lifetime_lock:
+            self.all_trigered += 1
+            if self.all_trigered >= self.num_running_thread:
+                self.all_started.set()
+
+    def thread_finished(self) -> None:
+        """Register a finished process and release the main thread once all processes are done."""
+        with self.lifetime_lock:
+            self.all_finished += 1
+            if self.all_finished >= self.num_running_thread:
+                self.all_done.set()
+
     def create_out_dirs(self, output_folder: Optional[str] = None) -> None:
         if output_folder is not None:
             self.output = output_folder
         else:
             self.output = "./outputs/"
 
-        os.makedirs(self.output, exist_ok=True)
-        os.makedirs(f"{self.output}/evaluation", exist_ok=True)
+        # NOTE this creates the output folder as a parent as well
+        os.makedirs(os.path.join(self.output, "evaluation"), exist_ok=True)
 
     def update_cam(self, cfg: DictConfig) -> None:
         """Update the camera intrinsics according to the pre-processing config, such as resize or edge crop"""
@@ -257,11 +281,11 @@ class SLAM:
     def load_pretrained(self, pretrained: str) -> None:
         self.info(f"Load pretrained checkpoint from {pretrained}!")
 
-        state_dict = OrderedDict([(k.replace("module.", ""), v) for (k, v) in torch.load(pretrained).items()])
-        state_dict["update.weight.2.weight"] = state_dict["update.weight.2.weight"][:2]
-        state_dict["update.weight.2.bias"] = state_dict["update.weight.2.bias"][:2]
-        state_dict["update.delta.2.weight"] = state_dict["update.delta.2.weight"][:2]
-        state_dict["update.delta.2.bias"] = state_dict["update.delta.2.bias"][:2]
+        # NOTE mmap the checkpoint, so we dont hold a second copy of it in host memory while renaming the keys
+        checkpoint = torch.load(pretrained, map_location="cpu", mmap=True, weights_only=True)
+        state_dict = {k.removeprefix("module."): v for k, v in checkpoint.items()}
+        for key in ["update.weight.2.weight", "update.weight.2.bias", "update.delta.2.weight", "update.delta.2.bias"]:
+            state_dict[key] = state_dict[key][:2]
 
         self.net.load_state_dict(state_dict)
 
@@ -273,19 +297,28 @@ class SLAM:
         condTracking: mp.Condition,
         semaBackend: mp.Semaphore,
         semaMapping: mp.Semaphore,
-        input_queue: mp.Queue,
+        input_queue: SharedFrameBuffer,
     ) -> None:
         """Main driver of framework by looping over the input stream"""
 
         self.info("Frontend tracking thread started!")
-        self.all_trigered += 1
+        self.thread_started()
 
         # Wait up for other threads to start
-        while self.all_trigered < self.num_running_thread:
-            pass
-
+        self.all_started.wait()
+
+        # NOTE decode and pin the next frames in background workers, while the frontend works on the current one
+        loader = DataLoader(
+            stream,
+            batch_size=1,
+            shuffle=False,
+            num_workers=2,
+            pin_memory=True,
+            prefetch_factor=2,
+            collate_fn=collate_single_item,
+        )
         # Main Loop which drives the whole system
-        for frame in tqdm(stream):
+        for frame in tqdm(loader):
 
             old_count = self.frontend.count  # Memoize current state
 
@@ -299,8 +332,7 @@ class SLAM:
 
             # Transmit the incoming stream to another visualization thread
             if self.cfg.show_stream:
-                input_queue.put(image)
-                input_queue.put(depth)
+                input_queue.put(image, depth)
 
             # If the Renderer / Mapping is currently optimizing, wait until that it is finished
             if self.frontend.count > self.mapping_warmup:
@@ -332,7 +364,7 @@ class SLAM:
         gc.collect()
 
         self.tracking_finished += 1
-        self.all_finished += 1
+        self.thread_finished()
         self.info("Frontend Tracking done!")
 
         # Release the Semaphores to avoid deadlock
@@ -354,7 +386,7 @@ class SLAM:
                 self.loop_detector.net = self.loop_detector.load_eigen()
 
         self.info("Loop Detection thread started!")
-        self.all_trigered += 1
+        self.thread_started()
 
         # Run as long as Frontend tracking gives use new frames
         while self.tracking_finished < 1 and run:
@@ -369,7 +401,7 @@ class SLAM:
         gc.collect()
 
         self.loop_detection_finished += 1
-        self.all_finished += 1
+        self.thread_finished()
         self.info("Loop Detection done!")
 
     def get_ram_usage(self) -> Tuple[float, float]:
@@ -382,6 +414,12 @@ class SLAM:
         In order to keep the system going, we simply dont use the backend until we can afford it again.
         """
         used_mem, free_mem = self.get_ram_usage()
+        # NOTE the backend often only looks full because of blocks cached by the allocator, release those first
+        if used_mem > max_ram and self.backend is not None:
+            gc.collect()
+            torch.cuda.empty_cache()
+            used_mem, free_mem = self.get_ram_usage()
+
         if used_mem > max_ram and self.backend is not None:
             print(colored(f"[Main]: Warning: Deleting Backend due to high memory usage [{used_mem} %]!", "red"))
             print(colored(f"[Main]: Warning: Warning: Got only {free_mem/ 1024 ** 3} GB left!", "red"))
@@ -421,7 +459,7 @@ class SLAM:
         self, rank: int, semaBackend: mp.Semaphore, loop_queue: Optional[mp.Queue] = None, run: bool = False
     ) -> None:
         self.info("Backend thread started!")
-        self.all_trigered += 1
+        self.thread_started()
 
         memoized_backend_count = 0
         all_lc_candidates = []
@@ -480,13 +518,16 @@ class SLAM:
                 msg = "Optimize full map: [{}, {}]!".format(0, t_end)
                 self.backend.info(msg)
 
-                ### 2 Refinement calls
+                ### Refinement calls
+                # NOTE each call rebuilds the factor graph from the refined poses, so restarting is not the same as more steps
+                steps = self.cfg.tracking.backend.get("refinement_steps", 6)
+                restarts = self.cfg.tracking.backend.get("refinement_restarts", 2)
                 if self.backend.enable_loop:
-                    _, _ = self.backend.optimizer.loop_ba(t_start=0, t_end=t_end, steps=6)
-                    _, _ = self.backend.optimizer.loop_ba(t_start=0, t_end=t_end, steps=6)
+                    refine_ba = self.backend.optimizer.loop_ba
                 else:
-                    _, _ = self.backend.optimizer.dense_ba(t_start=0, t_end=t_end, steps=6)
-                    _, _ = self.backend.optimizer.dense_ba(t_start=0, t_end=t_end, steps=6)
+                    refine_ba = self.backend.optimizer.dense_ba
+                for _ in range(restarts):
+                    _, _ = refine_ba(t_start=0, t_end=t_end, steps=steps)
 
                 del self.backend
                 torch.cuda.empty_cache()
@@ -498,7 +539,7 @@ class SLAM:
             gc.collect()
 
         self.backend_finished += 1
-        self.all_finished += 1
+        self.thread_finished()
         self.info("Backend done!")
 
     def maybe_reanchor_gaussians(self, pose_thresh: float = 0.001, scale_thresh: float = 0.1) -> None:
@@ -544,7 +585,7 @@ class SLAM:
         run: bool,
     ) -> None:
         self.info("Gaussian Mapping Triggered!")
-        self.all_trigered += 1
+        self.thread_started()
 
         while (self.tracking_finished + self.backend_finished) < 2 and run:
 
@@ -575,43 +616,47 @@ class SLAM:
         if self.cfg.run_backend:
             self.maybe_reanchor_gaussians()  # If the backend is also running, we reanchor Gaussians when large map changes occur
 
+        # NOTE we dont block inside the mapper after sending the final state, since the main thread only releases us after evaluation
         finished = False
         while not finished and run:
-            finished = self.gaussian_mapper(mapping_queue, received_mapping, True)
+            finished = self.gaussian_mapper(mapping_queue, None, True)
 
         self.gaussian_mapping_finished += 1
+        self.gaussian_mapping_done.set()
         # Let the user still interact with the GUI
-        while self.mapping_visualizing_finished < 1:
-            pass
+        self.mapping_visualizing_done.wait()
 
-        self.all_finished += 1
+        self.thread_finished()
+        # NOTE the main thread reads our final state through CUDA IPC handles without cloning it,
+        # so this process needs to keep the storages alive until evaluation is done
+        if run:
+            received_mapping.wait()
         self.info("Gaussian Mapping Done!")
 
     def visualizing(self, rank: int, run=True) -> None:
         """Vanilla Point Cloud Visualizer in Open3D"""
         self.info("Visualization thread started!")
-        self.all_trigered += 1
+        self.thread_started()
         finished = False
 
         while (self.tracking_finished + self.backend_finished < 2) and run and not finished:
             finished = droid_visualization(self.video, device=self.device, save_root=self.output)
 
         self.visualizing_finished += 1
-        self.all_finished += 1
+        self.thread_finished()
         self.info("Visualization done!")
 
     def mapping_gui(self, rank: int, run=True) -> None:
         """Gaussian Splatting Visualizer in Open3D"""
         self.info("Mapping GUI thread started!")
-        self.all_trigered += 1
+        self.thread_started()
         finished = False
 
         while (self.tracking_finished + self.backend_finished < 2) and run and not finished:
             finished = slam_gui.run(self.params_gui)
 
         # Wait for Gaussian Mapper to be finished so nothing new is put into the queue anymore
-        while self.gaussian_mapping_finished < 1:
-            pass
+        self.gaussian_mapping_done.wait()
 
         # empty all the guis that are in params_gui so this will for sure get empty
         if run:  # NOTE Leon: It crashes if we dont check this
@@ -621,27 +666,28 @@ class SLAM:
                 del obj
 
         self.mapping_visualizing_finished += 1
-        self.all_finished += 1
+        self.mapping_visualizing_done.set()
+        self.thread_finished()
         self.info("Mapping GUI done!")
 
-    def show_stream(self, rank, input_queue: mp.Queue, run=True) -> None:
+    def show_stream(self, rank, input_queue: SharedFrameBuffer, run=True) -> None:
         """Show the input RGBD stream (+ confidence of network) in separate windows"""
         self.info("OpenCV Image stream thread started!")
-        self.all_trigered += 1
+        self.thread_started()
 
         while (self.tracking_finished + self.backend_finished < 2) and run:
             if not input_queue.empty():
                 try:
-                    rgb = input_queue.get()
-                    depth = input_queue.get()
-
-                    rgb_image = rgb[0, [2, 1, 0], ...].permute(1, 2, 0).clone().cpu()
-                    cv2.imshow("RGB", rgb_image.numpy())
-                    if self.mode in ["rgbd", "prgbd"] and depth is not None:
-                        # Create normalized depth map with intensity plot
-                        depth_image = depth2rgb(depth.clone().cpu(), max_depth=self.max_depth_visu)[0]
-                        # Convert to BGR for cv2
-                        cv2.imshow("depth", depth_image[..., ::-1])
+                    with input_queue.get() as (rgb, depth):
+                        # NOTE indexing the channels already copies out of the shared slot
+                        rgb_image = rgb[0, [2, 1, 0], ...].permute(1, 2, 0)
+                        cv2.imshow("RGB", rgb_image.numpy())
+                        if self.mode in ["rgbd", "prgbd"] and depth is not None:
+                            # Create normalized depth map with intensity plot directly in BGR for cv2
+                            depth_image = tensor2bgr(
+                                depth, vmax=self.max_depth_visu, cmap="Spectral", mask_invalid=True
+                            )
+                            cv2.imshow("depth", depth_image)
                     cv2.waitKey(1)
                 except Exception as e:
                     # print(colored(e, "red"))
@@ -649,19 +695,40 @@ class SLAM:
 
             if self.plot_uncertainty:
                 # Plot the uncertainty on top
+                # NOTE we only need the lock to read the counter, the colormap reads the shared buffer directly
+                # (a frame that is updated concurrently is fine for visualization and avoids stalling the frontend)
                 with self.video.get_lock():
                     t_cur = max(0, self.video.counter.value - 1)
-                    if self.cfg.tracking.get("upsample", False):
-                        uncertanity_cur = self.video.confidence_up[t_cur].clone()
-                    else:
-                        uncertanity_cur = self.video.confidence[t_cur].clone()
-                uncertainty_img = uncertainty2rgb(uncertanity_cur)[0]
-                cv2.imshow("Uncertainty", uncertainty_img[..., ::-1])
+                if self.cfg.tracking.get("upsample", False):
+                    uncertanity_cur = self.video.confidence_up[t_cur]
+                else:
+                    uncertanity_cur = self.video.confidence[t_cur]
+                # NOTE colorize on the GPU and only download the final image
+                uncertainty_img = tensor2bgr(uncertanity_cur.detach(), cmap="turbo")
+                cv2.imshow("Uncertainty", uncertainty_img)
                 cv2.waitKey(1)
 
-        self.all_finished += 1
+        self.thread_finished()
         self.info("Show stream Done!")
 
+    def get_rendering_camera(self) -> Tuple[Tuple, Tuple, Tuple, torch.Tensor]:
+        """Get the intrinsics, field of view, image size and projection matrix shared by all rendered frames.
+
+        NOTE we cannot precompute this in update_cam, since the intrinsics in the video might have been optimized.
+        """
+        intrinsics = self.video.intrinsics[0]  # We always have the right global intrinsics stored here
+        if self.video.upsample:
+            intrinsics = intrinsics * self.video.scale_factor
+
+        fx, fy, cx, cy = intrinsics
+        height, width = self.H, self.W
+        fovx, fovy = focal2fov(fx, width), focal2fov(fy, height)
+        projection_matrix = getProjectionMatrix2(
+            self.gaussian_mapper.z_near, self.gaussian_mapper.z_far, cx, cy, fx, fy, width, height
+        )
+        projection_matrix = projection_matrix.transpose(0, 1).to(device=self.device)
+        return (fx, fy, cx, cy), (fovx, fovy), (height, width), projection_matrix
+
     def get_cams_for_rendering(
         self,
         stream,
@@ -682,13 +749,11 @@ class SLAM:
             indices = np.where(np.isin(np.array(self.tum_idx), np.array(self.tum_rgbd_idx)))[0]
             kf_idx = np.where(np.isin(np.array(indices), np.array(kf_tstamps)))[0]
             kf_tstamps = [tstamps[i] for i in kf_idx]
-            _, _, nonkf_tstamps = eval_utils.torch_intersect1d(torch.tensor(kf_tstamps), torch.tensor(indices))
-            nonkf_tstamps = [int(i) for i in nonkf_tstamps]
+            nonkf_tstamps = eval_utils.sorted_setdiff(indices, kf_tstamps)
             nonkf_idx = np.where(np.isin(np.array(indices), np.array(nonkf_tstamps)))[0]
         else:
             indices = range(len(est_c2w_all_lie))
-            _, _, nonkf_tstamps = eval_utils.torch_intersect1d(torch.tensor(kf_tstamps), torch.tensor(tstamps))
-            nonkf_tstamps = [int(i) for i in nonkf_tstamps]
+            nonkf_tstamps = eval_utils.sorted_setdiff(tstamps, kf_tstamps)
             kf_idx = kf_tstamps
             nonkf_idx = nonkf_tstamps
 
@@ -699,23 +764,16 @@ class SLAM:
             all_cams = gaussian_mapper_last_state.cameras
         else:
             all_cams = []
-            intrinsics = self.video.intrinsics[0]  # We always have the right global intrinsics stored here
-            if self.video.upsample:
-                intrinsics = intrinsics * self.video.scale_factor
+            # NOTE intrinsics and image size are shared by all frames, so we only build the projection once
+            (fx, fy, cx, cy), (fovx, fovy), (height, width), projection_matrix = self.get_rendering_camera()
+            # c2w -> w2c for initialization of all views in a single batch
+            frame_ids = torch.as_tensor(np.asarray(indices), dtype=torch.long, device=self.device)
+            vecs = torch.as_tensor(est_c2w_all_lie, device=self.device).float()[frame_ids]
+            views = SE3.InitFromVec(vecs).inv().matrix()
 
-            for i, idx in tqdm(enumerate(indices)):
-                view = est_c2w_all_lie[idx]
-                _, gt_image, gt_depth, _, _ = stream[i]
+            for i, view in tqdm(enumerate(views)):
 
-                # c2w -> w2c for initialization
-                view = SE3.InitFromVec(view.float().to(device=self.device)).inv().matrix()
-                fx, fy, cx, cy = intrinsics
-                height, width = gt_image.shape[-2:]
-                fovx, fovy = focal2fov(fx, width), focal2fov(fy, height)
-                projection_matrix = getProjectionMatrix2(
-                    self.gaussian_mapper.z_near, self.gaussian_mapper.z_far, cx, cy, fx, fy, width, height
-                )
-                projection_matrix = projection_matrix.transpose(0, 1).to(device=self.device)
+                _, gt_image, gt_depth, _, _ = stream[i]
                 new_cam = Camera(
                     i,
                     gt_image.contiguous(),
@@ -768,8 +826,7 @@ class SLAM:
             odometry_results = eval_utils.create_odometry_csv(
                 kf_result_ate, all_result_ate, self.cfg, stream.input_folder
             )
-            df = pd.DataFrame(odometry_results)
-            df.to_csv(os.path.join(eval_path, "odometry", "evaluation_results.csv"), index=False)
+            eval_utils.write_csv(odometry_results, os.path.join(eval_path, "odometry", "evaluation_results.csv"))
 
         else:
             self.info(
@@ -780,7 +837,12 @@ class SLAM:
         #### ------------------- ####
         ### Rendering  evaluation ###
         #### ------------------- ####
-        if self.cfg.run_mapping:
+        if self.cfg.run_mapping and gaussian_mapper_last_state is None:
+            self.info(
+                "Warning: Did not receive a final state from the Gaussian Mapper! Skipping rendering evaluation ...",
+                logger=log,
+            )
+        elif self.cfg.run_mapping:
             if self.mode == "prgbd":
                 if hasattr(stream, "switch_to_rgbd_gt") and callable(stream.switch_to_rgbd_gt):
                     self.info("Switching to RGBD groundtruth for evaluation ...", logger=log)
@@ -860,9 +922,9 @@ class SLAM:
             )
             # Check if the dataset has depth images
             if len(stream.depth_paths) != 0:
-                rendering_results["l1_depth"] = [kf_rnd_metrics["mean_l1"], nonkf_rnd_metrics["mean_l1"]]
-            render_df = pd.DataFrame(rendering_results)
-            render_df.to_csv(os.path.join(render_eval_path, "evaluation_results.csv"), index=False)
+                rendering_results[0]["l1_depth"] = kf_rnd_metrics["mean_l1"]
+                rendering_results[1]["l1_depth"] = nonkf_rnd_metrics["mean_l1"]
+            eval_utils.write_csv(rendering_results, os.path.join(render_eval_path, "evaluation_results.csv"))
 
     def get_trajectories(self, stream, gaussian_mapper_last_state: Optional[eval_utils.EvaluatePacket] = None):
         """Get the poses both for the whole video sequence and only the keyframes for evaluation.
@@ -887,13 +949,13 @@ class SLAM:
                 gaussian_mapper_last_state is not None
             ), "Missing GaussianMapper state for evaluation even though we ran Mapping!"
             est_w2c_all_matr = self.gaussian_mapper.get_camera_trajectory(gaussian_mapper_last_state.cameras)
-            est_w2c_all_lie = matrix_to_lie(est_w2c_all_matr)
+            est_w2c_all_lie = matrix_to_lie(est_w2c_all_matr.to(self.device))
             # Evo expects c2w convention (I think)
             est_c2w_all_lie = SE3.InitFromVec(est_w2c_all_lie).inv().vec()
 
             ## Get timestamps and make sanity check, that Gaussian Mapper has the same
-            kf_ids = torch.tensor(list(gaussian_mapper_last_state.cam2buffer.keys()))
-            kf_tstamps = self.video.timestamp[: self.video.counter.value].int().cpu()
+            kf_ids = torch.tensor(list(gaussian_mapper_last_state.cam2buffer.keys()), device=self.device)
+            kf_tstamps = self.video.timestamp[: self.video.counter.value].int()
             assert (
                 (kf_ids == kf_tstamps).all().item()
             ), """Gaussian Mapper should contain the keyframes at the same position as in 
@@ -913,18 +975,18 @@ class SLAM:
             # NOTE chen: even if we have optimized the poses with the GaussianMapper, we would have fed them back
             kf_tstamps = self.video.timestamp[: self.video.counter.value].int().cpu().tolist()
             est_w2c_all, tstamps = self.traj_filler(stream, return_tstamps=True)
-            est_c2w_all_lie = est_w2c_all.inv().vec().cpu()  # 7x1 Lie algebra
+            est_c2w_all_lie = est_w2c_all.inv().vec()  # 7x1 Lie algebra
             # Take from video directly without interpolation optimization
             est_w2c_kf_lie = self.video.poses[: self.video.counter.value]
             est_c2w_kf_lie = SE3.InitFromVec(est_w2c_kf_lie).inv().vec()
 
-        est_c2w_all_lie, est_c2w_kf_lie = est_c2w_all_lie.cpu(), est_c2w_kf_lie.cpu()
-
         # Evo evaluation package assumes lie algebras to be in form [tx, ty, tz, qw, qx, qy, qz]
         # while lietorch uses [qx, qy, qz, qw, tx, ty, tz]
+        # NOTE we convert on the device and only download the final results once
         traj_eval = {}
-        traj_eval["est_c2w_all_lie"] = lie_quat_swap_convention(est_c2w_all_lie.clone()).numpy()
-        traj_eval["est_c2w_kf_lie"] = lie_quat_swap_convention(est_c2w_kf_lie).numpy()
+        traj_eval["est_c2w_all_lie"] = lie_quat_swap_convention(est_c2w_all_lie).cpu().numpy()
+        traj_eval["est_c2w_kf_lie"] = lie_quat_swap_convention(est_c2w_kf_lie).cpu().numpy()
+        est_c2w_all_lie = est_c2w_all_lie.cpu()
         if stream.poses is not None:
             gt_c2w_all_lie = eval_utils.get_gt_c2w_from_stream(stream).float().cpu()
             gt_c2w_kf_lie = gt_c2w_all_lie[kf_tstamps]
@@ -947,22 +1009,15 @@ class SLAM:
             all_cams = gaussian_mapper_last_state.cameras
         else:
             all_cams = []
-            intrinsics = self.video.intrinsics[0]  # We always have the right global intrinsics stored here
-            if self.video.upsample:
-                intrinsics = intrinsics * self.video.scale_factor
+            # NOTE intrinsics and image size are shared by all frames, so we only build the projection once
+            (fx, fy, cx, cy), (fovx, fovy), (height, width), projection_matrix = self.get_rendering_camera()
+            # c2w -> w2c for initialization of all views in a single batch
+            vecs = torch.as_tensor(est_c2w_all_lie, device=self.device).float()
+            views = SE3.InitFromVec(vecs).inv().matrix()
 
-            for i, view in tqdm(enumerate(est_c2w_all_lie)):
+            for i, view in tqdm(enumerate(views)):
 
                 _, gt_image, gt_depth, _, _ = stream[i]
-                # c2w -> w2c for initialization
-                view = SE3.InitFromVec(view.float().to(device=self.device)).inv().matrix()
-                fx, fy, cx, cy = intrinsics
-                height, width = gt_image.shape[-2:]
-                fovx, fovy = focal2fov(fx, width), focal2fov(fy, height)
-                projection_matrix = getProjectionMatrix2(
-                    self.gaussian_mapper.z_near, self.gaussian_mapper.z_far, cx, cy, fx, fy, width, height
-                )
-                projection_matrix = projection_matrix.transpose(0, 1).to(device=self.device)
                 new_cam = Camera(
                     i,
                     gt_image.contiguous(),
@@ -1002,10 +1057,14 @@ class SLAM:
 
         self.info("Initiating termination ...", logger=log)
         # self.save_state()  # NOTE we dont save this for now, since the network stays the same
-        if self.do_evaluate:
-            self.info("Doing evaluation!", logger=log)
-            self.evaluate(stream, gaussian_mapper_last_state=gaussian_mapper_last_state)
-            self.info("Evaluation complete", logger=log)
+        try:
+            if self.do_evaluate:
+                self.info("Doing evaluation!", logger=log)
+                self.evaluate(stream, gaussian_mapper_last_state=gaussian_mapper_last_state)
+                self.info("Evaluation complete", logger=log)
+        finally:
+            # NOTE always release the mapping process, which owns the final Gaussians, else it blocks our exit
+            self.received_mapping.set()
 
         for i, p in enumerate(processes):
             p.terminate()
@@ -1071,32 +1130,32 @@ class SLAM:
 
         # Wait for all processes to have finished before terminating and for final mapping update to be transmitted
         if self.cfg.run_mapping:
-            while self.mapping_queue.empty():
-                pass
             # Receive the final update, so we can do something with it ...
-            a = self.mapping_queue.get()
-            self.info("Received final mapping update!", logger=log)
-            if a == "None":
-                a = deepcopy(a)
-                gaussian_mapper_last_state = None
-            else:
-                a.cameras_to("cpu")  # Put all dense tensors on the CPU before cloning to avoid OOM
-                gaussian_mapper_last_state = clone_obj(a)
-
-            del a  # NOTE Always delete receive object from a multiprocessing Queue!
-            torch.cuda.empty_cache()
-            gc.collect()
-            self.received_mapping.set()
+            # NOTE the packet holds zero-copy CUDA IPC views, which stay valid until we set self.received_mapping
+            # NOTE the mapper sends None when it has nothing to evaluate
+            # Block with a timeout, so we notice when the Mapping process died before sending anything
+            gaussian_mapper_last_state = None
+            mapping_process = next(p for p in processes if p.name == "Gaussian Mapping")
+            while True:
+                try:
+                    gaussian_mapper_last_state = self.mapping_queue.get(timeout=1.0)
+                    self.info("Received final mapping update!", logger=log)
+                    break
+                except queue.Empty:
+                    if not mapping_process.is_alive():
+                        print(colored("[Main]: Warning: Mapping died before sending its final state!", "red"))
+                        break
 
         # Let the processes run until they are finished (When using GUI's these need to be closed manually)
         else:
             gaussian_mapper_last_state = None
 
-        if gaussian_mapper_last_state is not None:
-            gaussian_mapper_last_state.cameras_to(self.device)
-
-        while self.all_finished < self.num_running_thread:
-            pass
+        # Block with a timeout, so we notice when a process crashed and will therefore never report as finished
+        while not self.all_done.wait(timeout=1.0):
+            crashed = [p.name for p in processes if not p.is_alive() and p.exitcode != 0]
+            if len(crashed) > 0:
+                print(colored(f"[Main]: Warning: {', '.join(crashed)} crashed before finishing!", "red"))
+                break
 
         self.info("##########", logger=log)
         end_time = perf_counter()
@@ -1,15 +1,18 @@
 import copy
+import queue
+from contextlib import contextmanager
+from typing import List, Optional, Tuple
 
 import torch
 import torch.multiprocessing as mp
 
 
 class FakeQueue:
-    def put(self, arg):
-        del arg
+    def put(self, *args, **kwargs):
+        del args, kwargs
 
     def get_nowait(self):
-        raise mp.queues.Empty
+        raise queue.Empty
 
     def qsize(self):
         return 0
@@ -18,6 +21,76 @@ class FakeQueue:
         return True
 
 
+class SharedFrameBuffer:
+    """Single-producer / single-consumer ring buffer of preallocated shared memory tensors.
+
+    Frames are copied once into a free slot by the producer and read in place by the consumer, so we
+    do not pickle every frame through the feeder thread of an mp.Queue.
+    """
+
+    def __init__(
+        self,
+        capacity: int,
+        image_shape: Tuple[int, ...],
+        depth_shape: Optional[Tuple[int, ...]] = None,
+        dtype: torch.dtype = torch.float32,
+    ):
+        self.capacity = capacity
+        self.images = torch.zeros((capacity, *image_shape), dtype=dtype).share_memory_()
+        if depth_shape is not None:
+            self.depths = torch.zeros((capacity, *depth_shape), dtype=dtype).share_memory_()
+        else:
+            self.depths = None
+        self.has_depth = torch.zeros((capacity), dtype=torch.bool).share_memory_()
+
+        self.head = mp.Value("Q", 0)  # Next slot to write
+        self.tail = mp.Value("Q", 0)  # Next slot to read
+        self.filled = mp.Semaphore(0)
+        self.free = mp.Semaphore(capacity)
+
+    def put(self, image: torch.Tensor, depth: Optional[torch.Tensor] = None, block: bool = False) -> bool:
+        """Copy a frame into the next free slot. When not blocking, the frame is dropped if the consumer lags behind."""
+        if not self.free.acquire(block=block):
+            return False
+        idx = self.head.value % self.capacity
+        self.images[idx].copy_(image.reshape(self.images.shape[1:]))
+        if depth is not None and self.depths is not None:
+            self.depths[idx].copy_(depth.reshape(self.depths.shape[1:]))
+            self.has_depth[idx] = True
+        else:
+            self.has_depth[idx] = False
+        self.head.value += 1
+        self.filled.release()
+        return True
+
+    @contextmanager
+    def get(self, timeout: Optional[float] = None):
+        """Yield views into the oldest filled slot. The slot is handed back to the producer when the context exits.
+
+        NOTE the yielded tensors alias shared memory, clone them if they need to outlive the context!
+        """
+        if not self.filled.acquire(timeout=timeout):
+            raise queue.Empty
+        idx = self.tail.value % self.capacity
+        depth = self.depths[idx] if self.depths is not None and bool(self.has_depth[idx]) else None
+        try:
+            yield self.images[idx], depth
+        finally:
+            self.tail.value += 1
+            self.free.release()
+
+    def qsize(self) -> int:
+        return self.head.value - self.tail.value
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
+
+
+def collate_single_item(batch: List[Tuple]) -> Tuple:
+    """Our datasets return single frames with optional None entries, which the default collate cannot stack."""
+    return batch[0]
+
+
 def clone_obj(obj):
     """Clone all torch.Tensor objects in an object."""
 
@@ -7,6 +7,8 @@ from termcolor import colored
 from pathlib import Path
 from tqdm import tqdm
 import os
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 import lietorch
@@ -21,6 +23,13 @@ import open3d as o3d
 from matplotlib.pyplot import get_cmap
 import matplotlib as mpl
 
+try:
+    import numba
+    from numba import prange
+except ImportError:
+    numba = None
+    prange = range
+
 # mpl.use("Qt5Agg")
 
 # Ignore warnings [DANGEROUS] (activate this when debugging!)
@@ -259,11 +268,8 @@ def depth2rgb(depths: torch.Tensor, min_depth: float = 0.0, max_depth: float = 5
     if depths.ndim == 2:
         depths = depths.unsqueeze(0)
 
-    depths = depths.cpu().numpy()
-    rgb = []
-    for depth in depths:
-        rgb.append(get_clipped_depth_visualization(depth, min_depth, max_depth))
-    return np.asarray(rgb)[..., :3]
+    # NOTE the colormap is a lookup table, so we can colorize the whole batch in one go
+    return get_clipped_depth_visualization(depths.cpu().numpy(), min_depth, max_depth)[..., :3]
 
 
 def uncertainty2rgb(weights: torch.Tensor, min_val: float = 0.0, cmap: str = "turbo") -> np.ndarray:
@@ -283,6 +289,41 @@ def uncertainty2rgb(weights: torch.Tensor, min_val: float = 0.0, cmap: str = "tu
     return np.asarray(rgb)[..., :3]
 
 
+@lru_cache(maxsize=8)
+def get_colormap_lut_np(cmap: str) -> np.ndarray:
+    """Sample a matplotlib colormap into a [256, 3] RGB lookup table."""
+    return get_cmap(cmap)(np.linspace(0.0, 1.0, 256))[:, :3].astype(np.float32)
+
+
+@lru_cache(maxsize=8)
+def get_colormap_lut(cmap: str, device: str = "cpu") -> torch.Tensor:
+    """Sample a matplotlib colormap into a [256, 3] BGR lookup table, so we can colorize directly on the device."""
+    lut = get_colormap_lut_np(cmap)[:, [2, 1, 0]]
+    return torch.as_tensor(lut, dtype=torch.float32, device=device)
+
+
+def tensor2bgr(
+    values: torch.Tensor,
+    vmin: float = 0.0,
+    vmax: Optional[float] = None,
+    cmap: str = "turbo",
+    mask_invalid: bool = False,
+) -> np.ndarray:
+    """Fused version of array2rgb for cv2 visualization: normalize, colorize and swap channels on the device
+    of values and only copy the final [H x W x 3] BGR image to the host.
+
+    NOTE like matplotlib we normalize with the maximum value if vmax is None and clip values outside [vmin, vmax]
+    We bin the values exactly like array2rgb, so both helpers produce the same colors.
+    """
+    vmax = float(values.max()) if vmax is None else vmax
+    scale = 256.0 / (vmax - vmin) if vmax > vmin else 0.0
+    idx = ((values - vmin) * scale).floor_().clamp_(0, 255).long()
+    bgr = get_colormap_lut(cmap, str(values.device))[idx]
+    if mask_invalid:
+        bgr[values <= 0] = 0.0  # Just mark invalid pixels black
+    return bgr.cpu().numpy()
+
+
 def get_clipped_depth_visualization(
     depth: np.ndarray,
     min_depth: float = 0.0,
@@ -303,7 +344,7 @@ def get_clipped_depth_visualization(
 
 
 def get_normalized_depth_visualization(
-    depth: np.ndarray,
+    depth: np.ndarray | torch.Tensor,
     pc: int = 98,
     crop_percent: float = 0,
     cmap: str = "magma",
@@ -317,19 +358,26 @@ def get_normalized_depth_visualization(
 
     NOTE If the depth map is a constant 0.0 aka your model produced garbage, this simply
     returns the input array.
+    NOTE Tensors are normalized on their device and only copied to the host for the colormap.
     """
+    if isinstance(depth, np.ndarray):
+        depth = torch.from_numpy(depth)
 
     vinds = depth > 0
     # convert to disparity
     depth = 1.0 / (depth + 1)
 
-    z1 = np.percentile(depth[vinds], pc)
-    z2 = np.percentile(depth[vinds], 100 - pc)
+    valid = depth[vinds]
+    # NOTE torch.quantile is limited to 2**24 elements, a random subset is equivalent for display purposes
+    if valid.numel() > 2**24:
+        valid = valid[torch.randint(valid.numel(), (2**24,), device=valid.device)]
+    q = torch.tensor([pc / 100, 1 - pc / 100], dtype=valid.dtype, device=valid.device)
+    z1, z2 = torch.quantile(valid, q)
 
-    depth = (depth - z2) / ((z1 - z2) + eps)
-    depth = np.clip(depth, 0, 1)
+    depth = ((depth - z2) / ((z1 - z2) + eps)).clamp(0, 1)
 
-    depth_rgb = array2rgb(depth, cmap=cmap)
+    depth_rgb = array2rgb(depth.cpu().numpy(), cmap=cmap)
+    vinds = vinds.cpu().numpy()
     # NOTE when we use this function for smoothness maps, we sometimes have an all False array
     if np.all(vinds):
         keep_H = int(depth_rgb.shape[0] * (1 - crop_percent))
@@ -357,22 +405,42 @@ def array2rgb(
     ---
     rgb_img: RGB array of shape [H x W x 3] or [B x H x W x 3]
     """
-    cmap = get_cmap(cmap)
-    norm = mpl.colors.Normalize(vmin=vmin, vmax=vmax)
-    rgba_img = cmap(norm(im).astype(np.float32))
-    rgb_img = np.delete(rgba_img, 3, -1)
-    return rgb_img
+    im = np.asarray(im, dtype=np.float32)
+    # NOTE like mpl.colors.Normalize we use the value range if no limits are given
+    vmin = float(im.min()) if vmin is None else vmin
+    vmax = float(im.max()) if vmax is None else vmax
+    scale = 256.0 / (vmax - vmin) if vmax > vmin else 0.0
+
+    lut = get_colormap_lut_np(cmap)
+    if numba is not None:
+        rgb_img = np.empty((im.size, 3), dtype=np.float32)
+        _colorize(im.reshape(-1), vmin, scale, lut, rgb_img)
+    else:
+        idx = np.clip(np.floor((im - vmin) * scale).astype(np.int64), 0, 255)
+        rgb_img = lut[idx]
+    return rgb_img.reshape(*im.shape, 3)
+
+
+def _colorize(values: np.ndarray, vmin: float, scale: float, lut: np.ndarray, out: np.ndarray) -> None:
+    """Look up the colormap entry for each value, this uses the same binning as a matplotlib colormap with 256 colors."""
+    for i in prange(values.shape[0]):
+        idx = int(np.floor((values[i] - vmin) * scale))
+        out[i] = lut[min(max(idx, 0), 255)]
+
+
+if numba is not None:
+    _colorize = numba.njit(cache=True, parallel=True)(_colorize)
 
 
 def white_balance(img):
     # from https://stackoverflow.com/questions/46390779/automatic-white-balancing-with-grayworld-assumption
-    result = cv2.cvtColor(img, cv2.COLOR_BGR2LAB)
-    avg_a = np.average(result[:, :, 1])
-    avg_b = np.average(result[:, :, 2])
-    result[:, :, 1] = result[:, :, 1] - ((avg_a - 128) * (result[:, :, 0] / 255.0) * 1.1)
-    result[:, :, 2] = result[:, :, 2] - ((avg_b - 128) * (result[:, :, 0] / 255.0) * 1.1)
-    result = cv2.cvtColor(result, cv2.COLOR_LAB2BGR)
-    return result
+    # NOTE we correct in float32 and clip once, instead of implicitly casting every channel back to uint8
+    lab = cv2.cvtColor(img, cv2.COLOR_BGR2LAB).astype(np.float32)
+    correction = lab[:, :, 0] * (1.1 / 255.0)
+    lab[:, :, 1] -= (lab[:, :, 1].mean() - 128) * correction
+    lab[:, :, 2] -= (lab[:, :, 2].mean() - 128) * correction
+    np.clip(lab, 0, 255, out=lab)
+    return cv2.cvtColor(lab.astype(np.uint8), cv2.COLOR_LAB2BGR)
 
 
 def create_camera_actor(g, scale=0.05):
@@ -401,29 +469,48 @@ def set_load_view_point(filename):
     ctr.convert_from_pinhole_camera_parameters(param)
 
 
-def write_pointclouds(pointclouds: Dict, target_folder: str, ext: str = "ply") -> None:
-    """Write out a list of point cloud geometries, so we can reload these in another script."""
-    if not os.path.exists(os.path.join(os.getcwd(), target_folder)):
-        os.makedirs(os.path.join(os.getcwd(), target_folder))
+def write_pointclouds(points: Dict, colors: Dict, target_folder: str, ext: str = "ply", max_workers: int = 8) -> None:
+    """Write out the per-frame [N, 3] points and colors as point clouds, so we can reload these in another script."""
+    base_path = os.path.join(os.getcwd(), target_folder)
+    os.makedirs(base_path, exist_ok=True)
 
-    for key, pointcloud in tqdm(pointclouds.items()):
-        o3d.io.write_point_cloud(
-            os.path.join(os.getcwd(), target_folder, str(key).zfill(4) + "." + ext),
+    def write(key) -> bool:
+        # NOTE we only cache numpy arrays during visualization, so we build the geometry when writing it out
+        pointcloud = create_point_actor(points[key], colors[key])
+        return o3d.io.write_point_cloud(
+            os.path.join(base_path, f"{str(key).zfill(4)}.{ext}"),
             pointcloud,
+            write_ascii=False,
+            compressed=True,
         )
+
+    # NOTE Open3D releases the GIL while writing, so we can overlap serialization and I/O of the many small files
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(tqdm(executor.map(write, points.keys()), total=len(points)))
     return
 
 
-def write_linesets(linesets: Dict, target_folder: str, ext: str = "ply") -> None:
-    """Write out a list of camera actor linesets, so we can reload these in another script."""
-    if not os.path.exists(os.path.join(os.getcwd(), target_folder)):
-        os.makedirs(os.path.join(os.getcwd(), target_folder))
+def write_linesets(cameras: Dict, target_folder: str, ext: str = "ply", max_workers: int = 8) -> None:
+    """Write out the per-frame camera frustum vertices as linesets, so we can reload these in another script."""
+    base_path = os.path.join(os.getcwd(), target_folder)
+    os.makedirs(base_path, exist_ok=True)
 
-    for key, lineset in tqdm(linesets.items()):
-        o3d.io.write_line_set(
-            os.path.join(os.getcwd(), target_folder, str(key).zfill(4) + "." + ext),
+    def write(item) -> bool:
+        key, cam_verts = item
+        lineset = o3d.geometry.LineSet(
+            points=o3d.utility.Vector3dVector(cam_verts),
+            lines=o3d.utility.Vector2iVector(CAM_LINES.astype(np.int32)),
+        )
+        lineset.paint_uniform_color((1.0, 0.0, 0.0))
+        return o3d.io.write_line_set(
+            os.path.join(base_path, f"{str(key).zfill(4)}.{ext}"),
             lineset,
+            write_ascii=False,
+            compressed=True,
         )
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(tqdm(executor.map(write, cameras.items()), total=len(cameras)))
     return
 
 
@@ -431,8 +518,12 @@ def droid_visualization(video, save_root: str = "results", device="cuda:0"):
     """DROID visualization frontend"""
     torch.cuda.set_device(device)
     droid_visualization.video = video
+    # Per keyframe geometry caches, which are merged into a single camera lineset and point cloud for drawing
     droid_visualization.cameras = {}
     droid_visualization.points = {}
+    droid_visualization.colors = {}
+    droid_visualization.camera_actor = None
+    droid_visualization.point_actor = None
     droid_visualization.warmup = 8
     droid_visualization.scale = 10.0  # 1.0
     droid_visualization.camera_scale = 0.025
@@ -446,6 +537,10 @@ def droid_visualization(video, save_root: str = "results", device="cuda:0"):
 
     droid_visualization.do_reset = True
 
+    # Side stream and pinned staging buffers for the device to host copies
+    droid_visualization.xfer_stream = torch.cuda.Stream(device=device)
+    droid_visualization.host_buffers = {}
+
     def increase_mv_filter(vis):
         droid_visualization.mv_filter_thresh *= 2
         with droid_visualization.video.get_lock():
@@ -498,72 +593,133 @@ def droid_visualization(video, save_root: str = "results", device="cuda:0"):
     def start_stop_view_resetting(vis):
         droid_visualization.do_reset = not droid_visualization.do_reset
 
+    def to_host(key: str, tensor: torch.Tensor) -> torch.Tensor:
+        """Copy a batch of frames asynchronously into a reusable pinned host buffer.
+        The buffers are sized for at least the whole video and only grow when a larger batch comes in, e.g. points.
+        """
+        buffer = droid_visualization.host_buffers.get(key)
+        if (
+            buffer is None
+            or len(buffer) < len(tensor)
+            or buffer.shape[1:] != tensor.shape[1:]
+            or buffer.dtype != tensor.dtype
+        ):
+            n_frames = max(video.poses.shape[0], tensor.shape[0])
+            buffer = torch.empty((n_frames, *tensor.shape[1:]), dtype=tensor.dtype, pin_memory=True)
+            droid_visualization.host_buffers[key] = buffer
+        host = buffer[: tensor.shape[0]]
+        host.copy_(tensor, non_blocking=True)
+        # Keep the allocator from reusing the device memory before the copy on the side stream is done
+        tensor.record_stream(torch.cuda.current_stream())
+        return host
+
     @torch.no_grad()
     def animation_callback(vis):
         cam_params = vis.get_view_control().convert_to_pinhole_camera_parameters()
 
+        # NOTE frames are only ever marked dirty up to the current counter, so we dont need to scan the whole buffer
+        # We only take a snapshot under the lock, torch.where synchronizes with the host and can run without it
         with video.get_lock():
             t = video.counter.value
-            (dirty_index,) = torch.where(video.dirty.clone())
-            dirty_index = dirty_index
+            dirty = video.dirty[:t].clone()
+        (dirty_index,) = torch.where(dirty)
 
         if len(dirty_index) == 0:
             return
 
-        video.dirty[dirty_index] = False
+        with video.get_lock():
+            video.dirty[dirty_index] = False
 
+        # NOTE gather only the subsampled images on the side stream, so this overlaps with the backend kernels below
         s = video.scale_factor
+        xfer_stream = droid_visualization.xfer_stream
+        xfer_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(xfer_stream):
+            images = video.images[..., int(s // 2 - 1) :: s, int(s // 2 - 1) :: s].index_select(0, dirty_index)
+            # NOTE 8 bit colors are enough for display and quarter the bytes we need to copy
+            images = images.permute(0, 2, 3, 1).mul(255).clamp_(0, 255).round_().to(torch.uint8)
+            images = to_host("images", images)
+
         poses = torch.index_select(video.poses, 0, dirty_index)
         disps = torch.index_select(video.disps, 0, dirty_index)
+        intrinsics = video.intrinsics[0]
         # convert poses to 4x4 matrix
-        Ps = SE3(poses).inv().matrix().cpu().numpy()
-        images = torch.index_select(video.images, 0, dirty_index)
-        images = images.cpu()[:, ..., int(s // 2 - 1) :: s, int(s // 2 - 1) :: s].permute(0, 2, 3, 1)
-        points = droid_backends.iproj(SE3(poses).inv().data, disps, video.intrinsics[0]).cpu()
+        poses_inv = SE3(poses).inv()
+        Ps = poses_inv.matrix()
 
         thresh = droid_visualization.mv_filter_thresh * torch.ones_like(disps.mean(dim=[1, 2]))
-        count = droid_backends.depth_filter(video.poses, video.disps, video.intrinsics[0], dirty_index, thresh)
-        count, disps = count.cpu(), disps.cpu()
-        # Only keep points that are consistent across multiple views and not too close by
-        masks = (count >= droid_visualization.mv_filter_count) & (disps > 0.5 * disps.mean(dim=[1, 2], keepdim=True))
-
+        count = droid_backends.depth_filter(video.poses, video.disps, intrinsics, dirty_index, thresh)
+        # NOTE the backprojection directly masks points that are inconsistent across multiple views or too close by
+        min_disps = 0.5 * disps.mean(dim=[1, 2])
+        if hasattr(droid_backends, "iproj_filter"):
+            points, masks = droid_backends.iproj_filter(
+                poses_inv.data, disps, intrinsics, count, min_disps, float(droid_visualization.mv_filter_count)
+            )
+        else:  # droid_backends was built before iproj_filter was added
+            points = droid_backends.iproj(poses_inv.data, disps, intrinsics)
+            masks = (count >= droid_visualization.mv_filter_count) & (disps > min_disps[:, None, None])
         if droid_visualization.uncertainty_filter_on:
             weights = torch.index_select(video.confidence, 0, dirty_index)
-            masks2 = weights > droid_visualization.unc_filter_thresh
-            masks = masks & masks2.cpu()
-
-        for i in range(len(dirty_index)):
-            pose = Ps[i]
-            ix = dirty_index[i].item()
-
-            if ix in droid_visualization.cameras:
-                vis.remove_geometry(
-                    droid_visualization.cameras[ix],
-                    reset_bounding_box=droid_visualization.do_reset,
-                )
-                del droid_visualization.cameras[ix]
-
-            if ix in droid_visualization.points:
-                vis.remove_geometry(
-                    droid_visualization.points[ix],
-                    reset_bounding_box=droid_visualization.do_reset,
-                )
-                del droid_visualization.points[ix]
-
-            ### add camera actor ###
-            cam_actor = create_camera_actor(True, droid_visualization.camera_scale)
-            cam_actor.transform(pose)
-            vis.add_geometry(cam_actor, reset_bounding_box=droid_visualization.do_reset)
-            droid_visualization.cameras[ix] = cam_actor
-
-            mask = masks[i].reshape(-1)
-            pts = points[i].reshape(-1, 3)[mask].numpy()
-            clr = images[i].reshape(-1, 3)[mask].numpy()
-
-            ## add point actor ###
-            point_actor = create_point_actor(pts, clr)
+            masks = masks & (weights > droid_visualization.unc_filter_thresh)
+        # Compact on the device, so we only copy the points that survive the filters
+        points = points[masks]
+
+        # NOTE copy everything on a side stream into pinned host buffers, so we only synchronize once before numpy
+        xfer_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(xfer_stream):
+            Ps, points, masks = to_host("poses", Ps), to_host("points", points), to_host("masks", masks)
+            xfer_done = torch.cuda.Event()
+            xfer_done.record(xfer_stream)
+        xfer_done.synchronize()
+        Ps = Ps.numpy()
+
+        # Split the valid points of all dirty frames by their per-frame counts, points and colors have the same order
+        n_dirty = len(dirty_index)
+        masks_all = masks.reshape(n_dirty, -1).numpy()
+        offsets = np.cumsum(masks_all.sum(axis=1))[:-1]
+        # NOTE points is a view into the reusable pinned buffer, so we need to copy before caching it per keyframe
+        pts_all = np.split(points.numpy().copy(), offsets)
+        clr_all = np.split(images.reshape(n_dirty, -1, 3).numpy()[masks_all].astype(np.float32) / 255.0, offsets)
+
+        # Transform the camera frustums of all dirty frames at once, Open3D needs float64 vertices
+        cam_points = (droid_visualization.camera_scale * CAM_POINTS).astype(np.float64)
+        cam_verts_all = np.einsum("kij,nj->kni", Ps[:, :3, :3], cam_points) + Ps[:, None, :3, 3]
+
+        # NOTE we only cache the per-frame geometry here and draw all keyframes as one point cloud and one lineset
+        for i, ix in enumerate(dirty_index.tolist()):
+            droid_visualization.cameras[ix] = cam_verts_all[i]
+            droid_visualization.points[ix] = pts_all[i]
+            droid_visualization.colors[ix] = clr_all[i]
+
+        cam_verts = np.concatenate(list(droid_visualization.cameras.values()))
+        all_pts = np.concatenate(list(droid_visualization.points.values()))
+        all_clr = np.concatenate(list(droid_visualization.colors.values()))
+
+        if droid_visualization.camera_actor is None:
+            droid_visualization.camera_actor = o3d.geometry.LineSet()
+            droid_visualization.point_actor = o3d.geometry.PointCloud()
+            is_new = True
+        else:
+            is_new = False
+
+        camera_actor, point_actor = droid_visualization.camera_actor, droid_visualization.point_actor
+        camera_actor.points = o3d.utility.Vector3dVector(cam_verts)
+        # NOTE the connectivity and color only change when new keyframes were added
+        n_cams = len(droid_visualization.cameras)
+        if len(camera_actor.lines) != n_cams * len(CAM_LINES):
+            cam_lines = (CAM_LINES[None] + len(CAM_POINTS) * np.arange(n_cams)[:, None, None]).reshape(-1, 2)
+            camera_actor.lines = o3d.utility.Vector2iVector(cam_lines.astype(np.int32))
+            camera_actor.paint_uniform_color((1.0, 0.0, 0.0))
+        point_actor.points = o3d.utility.Vector3dVector(all_pts)
+        point_actor.colors = o3d.utility.Vector3dVector(all_clr)
+
+        # NOTE we only add the geometries once and update them in place, this avoids rebuilding the scene
+        if is_new:
+            vis.add_geometry(camera_actor, reset_bounding_box=droid_visualization.do_reset)
             vis.add_geometry(point_actor, reset_bounding_box=droid_visualization.do_reset)
-            droid_visualization.points[ix] = point_actor
+        else:
+            vis.update_geometry(camera_actor)
+            vis.update_geometry(point_actor)
 
         # hack to allow interacting with vizualization during inference
         # if len(droid_visualization.cameras) >= droid_visualization.warmup:
@@ -602,7 +758,7 @@ def droid_visualization(video, save_root: str = "results", device="cuda:0"):
     #     o3d.io.write_pinhole_camera_parameters(save_root + "/final_viewpoint.json", param)
     #     pcl_path = str(Path(save_root) / "pointclouds")
     #     cam_path = str(Path(save_root) / "cameras")
-    #     write_pointclouds(droid_visualization.points, pcl_path, ext="xyzrgb")
+    #     write_pointclouds(droid_visualization.points, droid_visualization.colors, pcl_path)
     #     write_linesets(droid_visualization.cameras, cam_path)
     # except Exception as e:
     #     print(colored("[Visu] Something went wrong when saving the visualization ...!", "red"))